@@ -27,3 +27,48 @@ class Config:
     HTR_PIPELINE_FOLDER = 'htr_pipeline'
     CONFIG_PATH = os.path.join(DATA_FOLDER, 'config.json')
     WORDS_PATH = os.path.join(DATA_FOLDER, 'words_alpha.txt')
+    WORDS_TRIE_PATH = os.path.join(DATA_FOLDER, 'words_alpha.trie')  # compiled from WORDS_PATH on first use
+
+    # Precision of the OCR models: 'fp32', or 'int8' for the models created by `python -m htr_pipeline.quantize`
+    OCR_PRECISION = os.environ.get('OCR_PRECISION', 'fp32')
+
+    # Decoder of the word readouts: 'best_path', 'word_beam_search' or 'auto' (best path, dictionary constrained beam
+    # search only for words that are neither confident nor in the dictionary). 'auto' is opt-in until its confidence
+    # threshold is measured on real pages (python -m benchmarks.auto_decoder --samples DIR)
+    OCR_DECODER = os.environ.get('OCR_DECODER', 'best_path')
+    OCR_CONFIDENCE_THRESHOLD = float(os.environ.get('OCR_CONFIDENCE_THRESHOLD', 0.65))
+
+    # Read each word separately ('word'), or the words of a line stitched into one model input ('line', fewer
+    # inference calls)
+    OCR_READER_GRANULARITY = os.environ.get('OCR_READER_GRANULARITY', 'word')
+
+    # Scale at which words are detected: a number, or 'auto' (estimated per page from the height of the handwriting).
+    # 'auto' is opt-in until it is measured on real pages (python -m benchmarks.auto_scale --samples DIR)
+    OCR_DETECTOR_SCALE = os.environ.get('OCR_DETECTOR_SCALE', '1.0')
+    if OCR_DETECTOR_SCALE != 'auto':
+        OCR_DETECTOR_SCALE = float(OCR_DETECTOR_SCALE)
+
+    # Read the pages of a submission in a pipeline (detection, reading and text correction of different pages overlap)
+    # instead of all pages in shared batches
+    OCR_PIPELINED = os.environ.get('OCR_PIPELINED', '0') == '1'
+
+    # Cache of read pages ('memory', 'disk', 'redis' or 'none'), re-uploaded or re-graded scans are not read again
+    OCR_CACHE_BACKEND = os.environ.get('OCR_CACHE_BACKEND', 'memory')
+    OCR_CACHE_MAX_MB = int(os.environ.get('OCR_CACHE_MAX_MB', 64))
+    OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', os.path.join(DATA_FOLDER, 'page_cache'))
+    OCR_CACHE_REDIS_URL = os.environ.get('OCR_CACHE_REDIS_URL', 'redis://localhost:6379/1')
+
+    # Tiled word detection for large scans (bounds the memory of the detector), disabled if OCR_TILE_SIZE is 0
+    OCR_TILE_SIZE = int(os.environ.get('OCR_TILE_SIZE', 0)) or None
+    OCR_TILE_OVERLAP = int(os.environ.get('OCR_TILE_OVERLAP', 256))
+    OCR_TILE_WORKERS = int(os.environ.get('OCR_TILE_WORKERS', 1))
+
+    # ONNX Runtime configuration of the OCR models, applied to each Celery worker process.
+    # With several worker processes per host, set ORT_INTRA_OP_THREADS to cores / processes.
+    ORT_INTRA_OP_THREADS = int(os.environ.get('ORT_INTRA_OP_THREADS', 0))
+    ORT_INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', 0))
+    ORT_ALLOW_SPINNING = os.environ.get('ORT_ALLOW_SPINNING', '1') == '1'
+    ORT_EXECUTION_MODE = os.environ.get('ORT_EXECUTION_MODE', 'sequential')
+    ORT_GRAPH_OPTIMIZATION_LEVEL = os.environ.get('ORT_GRAPH_OPTIMIZATION_LEVEL', 'all')
+    ORT_OPTIMIZED_MODEL_DIR = os.environ.get('ORT_OPTIMIZED_MODEL_DIR')
+    ORT_ENABLE_PROFILING = os.environ.get('ORT_ENABLE_PROFILING', '0') == '1'
@@ -3,7 +3,7 @@ import uuid
 from flask import Blueprint, request, jsonify
 from app.models import db, Submission, SubmissionImage, Student, ModelAnswer, Category
 from app.services.s3_service import upload_file_to_s3, download_file_from_s3
-from app.tasks import process_submission
+from app import celery
 from werkzeug.utils import secure_filename
 
 submissions_bp = Blueprint('submissions', __name__)
@@ -59,8 +59,8 @@ def create_submission():
 
     db.session.commit()
 
-    # Queue the background task
-    process_submission.delay(new_submission.id)
+    # Queue the background task by name, so the web process never imports the task module (and the ML stack)
+    celery.send_task('app.tasks.process_submission', args=[new_submission.id])
 
     return jsonify({
         'message': 'Submission received and is being processed.',
@@ -10,7 +10,10 @@ class BERTService:
         self.tokenizer = None
         self.model = None
 
-    def _load_model(self):
+    def load(self):
+        """
+        Loads the tokenizer and the model if they are not loaded yet (evaluate_answers loads them on first use).
+        """
         if self.tokenizer is None or self.model is None:
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
             self.model = BertModel.from_pretrained('bert-base-uncased')
@@ -37,7 +40,7 @@ class BERTService:
         return length_ratio
 
     def evaluate_answers(self, teacher_answers, student_answers, total_test_marks):
-        self._load_model()
+        self.load()
         start_time = time.time()
 
         student_answers_dict = {item['question_id']: item['corrected_text'] for item in student_answers}
@@ -1,25 +1,89 @@
+import os
 import cv2
 import numpy as np
 import re
 from flask import current_app
-from htr_pipeline import read_page, DetectorConfig, LineClusteringConfig, ReaderConfig, PrefixTree
+from htr_pipeline import iter_read_pages, read_page, read_pages, DetectorConfig, LineClusteringConfig, ReaderConfig, PrefixTree
+from htr_pipeline.cache import PageCache, MemoryBackend, DiskBackend, RedisBackend
 from app.services.gemini_service import GeminiService
 
 
+def create_page_cache(config):
+    """
+    Creates the cache of read pages configured by OCR_CACHE_BACKEND ('memory', 'disk', 'redis' or 'none').
+
+    :param config: The app config.
+    :return: A PageCache, or None if caching is disabled.
+    """
+    backend = config['OCR_CACHE_BACKEND']
+    max_bytes = config['OCR_CACHE_MAX_MB'] * 2 ** 20
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return PageCache(MemoryBackend(max_bytes))
+    if backend == 'disk':
+        return PageCache(DiskBackend(config['OCR_CACHE_DIR'], max_bytes))
+    if backend == 'redis':
+        return PageCache(RedisBackend.from_url(config['OCR_CACHE_REDIS_URL'], max_bytes=max_bytes))
+    raise ValueError(f"Unknown OCR_CACHE_BACKEND: {backend}")
+
+
+def load_prefix_tree(words_path, trie_path):
+    """
+    Loads the prefix tree from its compiled binary file (memory-mapped, shared between worker processes).
+    The file is compiled from the word list if it is missing or older than the word list.
+    """
+    if not os.path.exists(trie_path) or os.path.getmtime(trie_path) < os.path.getmtime(words_path):
+        with open(words_path) as f:
+            word_list = [w.strip().upper() for w in f.readlines()]
+        prefix_tree = PrefixTree(word_list)
+        try:
+            prefix_tree.save(trie_path)
+        except OSError as e:
+            print(f"Could not save compiled prefix tree to {trie_path}: {e}")
+            return prefix_tree
+    return PrefixTree.load(trie_path)
+
+
 class OCRService:
-    def __init__(self):
+    def __init__(self, prefix_tree=None, gemini_service=None, page_cache=None):
         """
         Initializes the OCR service, loading the word list for the prefix tree.
+        Already loaded instances can be passed to share them between services (see app.services.registry).
+
+        :param prefix_tree: Optional prefix tree containing the dictionary words.
+        :param gemini_service: Optional Gemini service used to correct the recognized text.
+        :param page_cache: Optional cache of read pages, identical images are then only read once.
         """
-        self.gemini_service = GeminiService()
+        self.gemini_service = gemini_service or GeminiService()
+        self.page_cache = page_cache
+        if prefix_tree is not None:
+            self.prefix_tree = prefix_tree
+            return
         try:
-            with open(current_app.config['WORDS_PATH']) as f:
-                word_list = [w.strip().upper() for w in f.readlines()]
-            self.prefix_tree = PrefixTree(word_list)
+            self.prefix_tree = load_prefix_tree(current_app.config['WORDS_PATH'], current_app.config['WORDS_TRIE_PATH'])
         except Exception as e:
             print(f"Could not load words_alpha.txt: {e}")
             self.prefix_tree = None
 
+    def _pipeline_configs(self):
+        """
+        Returns the detector, line clustering and reader configurations of the HTR pipeline.
+        """
+        detector_config = DetectorConfig(scale=current_app.config['OCR_DETECTOR_SCALE'],
+                                         precision=current_app.config['OCR_PRECISION'],
+                                         tile_size=current_app.config['OCR_TILE_SIZE'],
+                                         tile_overlap=current_app.config['OCR_TILE_OVERLAP'],
+                                         tile_workers=current_app.config['OCR_TILE_WORKERS'])
+        line_clustering_config = LineClusteringConfig(min_words_per_line=1)
+        # without dictionary, only best path decoding is possible
+        decoder = current_app.config['OCR_DECODER'] if self.prefix_tree is not None else 'best_path'
+        reader_config = ReaderConfig(decoder=decoder, prefix_tree=self.prefix_tree,
+                                     precision=current_app.config['OCR_PRECISION'],
+                                     confidence_threshold=current_app.config['OCR_CONFIDENCE_THRESHOLD'],
+                                     granularity=current_app.config['OCR_READER_GRANULARITY'])
+        return detector_config, line_clustering_config, reader_config
+
     def process_image(self, image_path):
         """
         Processes a single image file to extract and correct handwritten text,
@@ -28,19 +92,80 @@ class OCRService:
         :param image_path: The local path to the image file to process.
         :return: A dictionary containing the processing results.
         """
-        try:
-            img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        return self.process_images([image_path])[0]
+
+    def process_images(self, image_paths):
+        """
+        Processes the page images of a submission like process_image, but runs the HTR pipeline
+        on all pages at once, which shares the model inference calls between the pages.
+
+        :param image_paths: The local paths to the image files to process.
+        :return: A list with one result dictionary (see process_image) per image.
+        """
+        results = [None] * len(image_paths)
+        configs = self._pipeline_configs()
+        imgs, img_indices, cache_keys = [], [], []
+        for i, image_path in enumerate(image_paths):
+            try:
+                with open(image_path, 'rb') as f:
+                    image_bytes = f.read()
+            except OSError:
+                image_bytes = b''
+
+            # Pages read before (same file content and settings) are taken from the cache
+            cache_key = self.page_cache.key(image_bytes, *configs) if self.page_cache and image_bytes else None
+            read_lines = self.page_cache.get(cache_key) if cache_key else None
+            if read_lines is not None:
+                results[i] = self._extract_questions(read_lines)
+                continue
+
+            img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE) if image_bytes else None
             if img is None:
-                raise FileNotFoundError(f"Image not found at path: {image_path}")
+                error = f"Image not found at path: {image_path}"
+                print(f"Error in OCRService process_image: {error}")
+                results[i] = {'success': False, 'error': error}
+                continue
+            imgs.append(img)
+            img_indices.append(i)
+            cache_keys.append(cache_key)
 
-            # Use the HTR pipeline to read all text from the page
-            read_lines = read_page(
-                img,
-                detector_config=DetectorConfig(),
-                line_clustering_config=LineClusteringConfig(min_words_per_line=1),
-                reader_config=ReaderConfig(decoder='best_path', prefix_tree=self.prefix_tree)
-            )
+        try:
+            # Use the HTR pipeline to read all text from the pages, either all pages at once, or pipelined,
+            # which already segments and corrects the text of a page while the next pages are read
+            read = iter_read_pages if current_app.config['OCR_PIPELINED'] else read_pages
+            for i, cache_key, read_lines in zip(img_indices, cache_keys, read(imgs, *configs) if imgs else []):
+                self._store_page(i, cache_key, read_lines, results)
+        except Exception as e:
+            # A failing page must not fail the other pages of the submission, so the pages without result
+            # are read again one by one
+            print(f"Error in OCRService process_image, reading the remaining pages one by one: {e}")
+            for i, img, cache_key in zip(img_indices, imgs, cache_keys):
+                if results[i] is not None:
+                    continue
+                try:
+                    self._store_page(i, cache_key, read_page(img, *configs), results)
+                except Exception as e:
+                    print(f"Error in OCRService process_image: {e}")
+                    results[i] = {'success': False, 'error': str(e)}
+        return results
 
+    def _store_page(self, i, cache_key, read_lines, results):
+        """
+        Stores the read lines of page i in the page cache, and its extracted answers in results.
+        """
+        if cache_key:
+            self.page_cache.put(cache_key, read_lines)
+        results[i] = self._extract_questions(read_lines)
+
+    def _extract_questions(self, read_lines):
+        """
+        Segments the text read from a page into answers by identifying question numbers,
+        and corrects the text of each answer.
+
+        :param read_lines: The lines of a page as returned by the HTR pipeline.
+        :return: A dictionary containing the processing results.
+        """
+        try:
             full_text = '\\n'.join([' '.join([word.text for word in line]) for line in read_lines])
 
             # This regex looks for patterns like "1.", "2a)", "3 b.", etc., at the start of a line.
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from flask import current_app
+
+
+class SharedResource:
+    """
+    A lazily loaded resource (service instance, lexicon, ...) that is shared by all tasks of a worker process.
+    The resource is reloaded when the file it was loaded from changes, or when one of the resources it
+    depends on was reloaded.
+    """
+
+    def __init__(self, name, loader, path_config_key=None, depends_on=()):
+        """
+        :param name: Name of the resource.
+        :param loader: Function creating the resource. Gets the resolved path if path_config_key is set.
+        :param path_config_key: Optional app config key of the file the resource is loaded from.
+        :param depends_on: Names of resources which are passed to the loader as keyword arguments.
+        """
+        self.name = name
+        self.loader = loader
+        self.path_config_key = path_config_key
+        self.depends_on = depends_on
+        self.value = None
+        self.loaded_at = None
+        self.load_duration = None
+        self.source_path = None
+        self.source_mtime = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self, deps):
+        if self.loaded_at is None:
+            return True
+        if any(dep.loaded_at > self.loaded_at for dep in deps):
+            return True
+        if self.path_config_key:
+            path = current_app.config[self.path_config_key]
+            return path != self.source_path or _get_mtime(path) != self.source_mtime
+        return False
+
+    def get(self):
+        deps = [get_resource(name) for name in self.depends_on]
+        with self._lock:
+            if self._is_stale(deps):
+                self._load(deps)
+            return self.value
+
+    def _load(self, deps):
+        kwargs = {dep.name: dep.value for dep in deps}
+        if self.path_config_key:
+            self.source_path = current_app.config[self.path_config_key]
+            self.source_mtime = _get_mtime(self.source_path)
+            kwargs['path'] = self.source_path
+
+        start_time = time.time()
+        self.value = self.loader(**kwargs)
+        self.load_duration = round(time.time() - start_time, 3)
+        self.loaded_at = datetime.now(timezone.utc)
+        print(f"Loaded shared resource '{self.name}' in {self.load_duration}s (pid {os.getpid()}).")
+
+    def status(self):
+        return {
+            'loaded': self.loaded_at is not None,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'load_duration': self.load_duration,
+            'source_path': self.source_path,
+            'source_mtime': self.source_mtime,
+        }
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _load_lexicon(path):
+    from app.services.ocr_service import load_prefix_tree
+    try:
+        return load_prefix_tree(path, current_app.config['WORDS_TRIE_PATH'])
+    except Exception as e:
+        print(f"Could not load words_alpha.txt: {e}")
+        return None
+
+
+def _load_gemini():
+    from app.services.gemini_service import GeminiService
+    return GeminiService()
+
+
+def _load_bert():
+    from app.services.bert_service import BERTService
+    service = BERTService()
+    service.load()
+    return service
+
+
+def _load_page_cache():
+    from app.services.ocr_service import create_page_cache
+    return create_page_cache(current_app.config)
+
+
+def _load_ocr(lexicon, gemini, page_cache):
+    from app.services.ocr_service import OCRService
+    return OCRService(prefix_tree=lexicon, gemini_service=gemini, page_cache=page_cache)
+
+
+_RESOURCES = {
+    resource.name: resource for resource in [
+        SharedResource('lexicon', _load_lexicon, path_config_key='WORDS_PATH'),
+        SharedResource('gemini', _load_gemini),
+        SharedResource('bert', _load_bert),
+        SharedResource('page_cache', _load_page_cache),
+        SharedResource('ocr', _load_ocr, depends_on=('lexicon', 'gemini', 'page_cache')),
+    ]
+}
+
+
+def get_resource(name):
+    """
+    Returns the shared resource entry with the given name, loading (or reloading) it if needed.
+
+    :param name: One of 'lexicon', 'gemini', 'bert', 'page_cache', 'ocr'.
+    """
+    resource = _RESOURCES[name]
+    resource.get()
+    return resource
+
+
+def get_service(name):
+    """
+    Returns the warm, process-wide instance of the given service.
+
+    :param name: One of 'lexicon', 'gemini', 'bert', 'page_cache', 'ocr'.
+    """
+    return get_resource(name).value
+
+
+def get_status():
+    """
+    Returns the load status of all shared resources of this process, without loading anything.
+    """
+    return {'pid': os.getpid(), 'resources': {name: r.status() for name, r in _RESOURCES.items()}}
@@ -1,13 +1,44 @@
 import os
 import json
+from celery.signals import worker_process_init
 from app import celery  # Import the celery instance from __init__
+from app.config import Config
 from app.extensions import db
 from app.services.s3_service import download_file_from_s3, upload_file_to_s3
-from app.services.ocr_service import OCRService
-from app.services.bert_service import BERTService
+from app.services.registry import get_service, get_status
 from app.models import Submission, ModelAnswer
 
 
+@worker_process_init.connect
+def warmup_worker_process(**kwargs):
+    """
+    Configures ONNX Runtime and loads the OCR models when a worker process starts,
+    so the first submission does not pay for it.
+    """
+    try:
+        import htr_pipeline
+        htr_pipeline.configure_runtime(htr_pipeline.RuntimeConfig(
+            intra_op_num_threads=Config.ORT_INTRA_OP_THREADS,
+            inter_op_num_threads=Config.ORT_INTER_OP_THREADS,
+            allow_spinning=Config.ORT_ALLOW_SPINNING,
+            execution_mode=Config.ORT_EXECUTION_MODE,
+            graph_optimization_level=Config.ORT_GRAPH_OPTIMIZATION_LEVEL,
+            optimized_model_dir=Config.ORT_OPTIMIZED_MODEL_DIR,
+            enable_profiling=Config.ORT_ENABLE_PROFILING,
+        ))
+        htr_pipeline.warmup(Config.OCR_PRECISION)
+    except Exception as e:
+        print(f"Could not warm up OCR models: {e}")
+
+
+@celery.task(name='app.tasks.service_status')
+def service_status():
+    """
+    Celery task reporting which shared services are loaded in the worker process executing it, and when.
+    """
+    return get_status()
+
+
 @celery.task(name='app.tasks.process_submission')
 def process_submission(submission_id):
     """
@@ -31,7 +62,7 @@ def process_submission(submission_id):
         total_test_marks = model_answer_data.get('total_test_marks', 100)
 
         # 2. Process each image with OCR service
-        ocr_service = OCRService()
+        ocr_service = get_service('ocr')
         all_student_answers = []
 
         sorted_images = sorted(submission.images, key=lambda x: x.page_order)
@@ -41,21 +72,28 @@ def process_submission(submission_id):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
+        temp_image_paths = []
         for image_record in sorted_images:
             image_content = download_file_from_s3(image_record.s3_key)
 
             temp_image_path = os.path.join(temp_dir, os.path.basename(image_record.s3_key))
             with open(temp_image_path, 'wb') as f:
                 f.write(image_content)
+            temp_image_paths.append(temp_image_path)
 
-            ocr_result = ocr_service.process_image(temp_image_path)
-            os.remove(temp_image_path)
+        # All pages are read at once, so they share the model inference calls
+        try:
+            ocr_results = ocr_service.process_images(temp_image_paths)
+        finally:
+            for temp_image_path in temp_image_paths:
+                os.remove(temp_image_path)
 
+        for ocr_result in ocr_results:
             if ocr_result.get('success'):
                 all_student_answers.extend(ocr_result.get('questions', []))
 
         # 3. Evaluate with BERT service
-        bert_service = BERTService()
+        bert_service = get_service('bert')
         evaluation_summary = bert_service.evaluate_answers(
             teacher_answers, all_student_answers, total_test_marks
         )
@@ -0,0 +1,120 @@
+"""Confidence threshold of the 'auto' decoder: how many words it sends to beam search, and how accurate it is.
+
+Words of the dictionary are turned into reader-like outputs (see word_predictions). Half of the words are read
+cleanly, for the other half the evidence of one char is split between the true char and a wrong one, so the best path
+is wrong about half of the time. For each confidence threshold, the fraction of words actually decoded with beam search
+(words below the threshold whose best path is not a dictionary word), the word accuracy and the decoding time per word
+are reported, next to best path and word beam search. Also reported are percentiles of the confidence (see
+htr_pipeline.reader._confidences) of clean and unsure words, so the threshold can be placed between them. The
+dictionary is upper-cased like the lexicon of the app.
+
+With --samples, the confidences of the words read from sample pages (image plus ground truth .txt, see
+htr_pipeline.evaluation.load_samples) are reported instead, split into words that match the ground truth or not.
+
+Usage:
+    python -m benchmarks.auto_decoder [--num-words 1000] [--noise 0.5] [--thresholds 0.5 0.7 0.8 0.9]
+    python -m benchmarks.auto_decoder --samples DIR
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.suite import CHARS, WORDS_PATH
+from htr_pipeline import PipelineStats, profile
+from htr_pipeline.reader import _decode
+from htr_pipeline.reader.ctc import PrefixTree
+
+_LOWER = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def word_predictions(words, rng: np.random.Generator, noise: float, unsure: np.ndarray, steps_per_char: int = 4):
+    """Reader-like output (WxBxC softmax) for the given words: each char is predicted for a few time-steps, separated by
+    blanks, with noise of the given standard deviation on the logits. For the unsure words, one char is predicted
+    together with a wrong char of nearly the same strength (stronger or weaker, at random)."""
+    label = {c: i + 1 for i, c in enumerate(CHARS)}
+    num_timesteps = max(len(word) for word in words) * steps_per_char + 8
+    logits = rng.normal(0, noise, (num_timesteps, len(words), len(CHARS) + 1))
+    logits[..., 0] += 6  # blank
+    for b, word in enumerate(words):
+        for k, c in enumerate(word):
+            t = 4 + k * steps_per_char
+            logits[t:t + steps_per_char - 1, b, label[c]] += 10
+        if unsure[b]:
+            t = 4 + rng.integers(len(word)) * steps_per_char
+            wrong = rng.choice([c for c in _LOWER if c not in word])
+            logits[t:t + steps_per_char - 1, b, label[wrong]] += 10 + rng.choice([-0.3, 0.3])
+    logits = np.exp(logits - logits.max(axis=2, keepdims=True))
+    return (logits / logits.sum(axis=2, keepdims=True)).astype(np.float32)
+
+
+def run(predictions, words, decoder, prefix_tree, threshold=0.0):
+    """Decode, returns the accuracy, the seconds per word, the confidences and the fraction of the words that were
+    decoded with beam search."""
+    with profile(PipelineStats()) as stats:
+        t = time.perf_counter()
+        texts, confidences = _decode(predictions, decoder, prefix_tree, CHARS, threshold)
+        seconds = (time.perf_counter() - t) / len(words)
+    if decoder == 'word_beam_search':
+        beam_searched = 1.0
+    else:
+        # words sent to beam search by the 'auto' decoder, i.e. neither confident nor in the dictionary
+        beam_searched = stats.summary().get('read.ctc_beam_search', {'items': 0})['items'] / len(words)
+    return float(np.mean([text == word for text, word in zip(texts, words)])), seconds, confidences, beam_searched
+
+
+def percentiles(values) -> str:
+    return ' '.join(f'{p}%: {np.percentile(values, p):.3f}' for p in (5, 25, 50, 75, 95)) if len(values) else '-'
+
+
+def synthetic(args):
+    with open(WORDS_PATH) as f:
+        dictionary = [word.strip() for word in f]
+    prefix_tree = PrefixTree([word.upper() for word in dictionary])
+    rng = np.random.default_rng(0)
+    words = [w for w in rng.choice(dictionary, 4 * args.num_words) if 2 <= len(w) <= 12][:args.num_words]
+    unsure = rng.random(len(words)) < 0.5
+    predictions = word_predictions(words, rng, args.noise, unsure)
+    _decode(predictions[:, :8], 'auto', prefix_tree, CHARS, 1.1)  # warm up (label tables of the tree)
+
+    _, _, confidences, _ = run(predictions, words, 'best_path', None)
+    print(f'confidence of clean words:  {percentiles(confidences[~unsure])}')
+    print(f'confidence of unsure words: {percentiles(confidences[unsure])}\n')
+
+    print(f'{"decoder":<24} {"beam searched":>13} {"accuracy":>9} {"ms/word":>8}')
+    rows = [('best_path', 'best_path', 0.0), ('word_beam_search', 'word_beam_search', 0.0)]
+    rows += [(f'auto {threshold}', 'auto', threshold) for threshold in args.thresholds]
+    for name, decoder, threshold in rows:
+        accuracy, seconds, _, beam_searched = run(predictions, words, decoder, prefix_tree, threshold)
+        print(f'{name:<24} {beam_searched:13.1%} {accuracy:9.1%} {seconds * 1000:8.3f}')
+
+
+def samples(args):
+    from htr_pipeline import DetectorConfig, read_page
+    from htr_pipeline.evaluation import load_samples
+
+    correct, wrong = [], []
+    for sample in load_samples(args.samples):
+        read_lines = read_page(sample.img, DetectorConfig(sample.scale, sample.margin))
+        gt_words = set(sample.gt_text.split())
+        for word in (word for line in read_lines for word in line):
+            (correct if word.text in gt_words else wrong).append(word.confidence)
+    print(f'confidence of words found in the ground truth ({len(correct)}): {percentiles(correct)}')
+    print(f'confidence of other words ({len(wrong)}): {percentiles(wrong)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', help='directory with sample pages and ground truth texts')
+    parser.add_argument('--num-words', type=int, default=1000)
+    parser.add_argument('--noise', type=float, default=0.5, help='standard deviation of the noise of the logits')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.5, 0.7, 0.8, 0.9, 0.95])
+    args = parser.parse_args()
+    if args.samples:
+        samples(args)
+    else:
+        synthetic(args)
+
+
+if __name__ == '__main__':
+    main()
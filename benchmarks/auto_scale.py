@@ -0,0 +1,69 @@
+"""Speed and accuracy of automatic detector scale selection compared to fixed scales.
+
+Every sample page (image plus ground truth .txt, see htr_pipeline.evaluation.load_samples) is read with each fixed
+scale, with the scale of the sample's config.json entry, and with scale='auto'. For each setting, pages/s, the mean
+number of detector input pixels and the character error rate are reported.
+
+Usage: python -m benchmarks.auto_scale --samples DIR [--scales 1.0 0.5 0.4 0.3 0.25] [--repeat 1]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from htr_pipeline import DetectorConfig, LineClusteringConfig, read_page
+from htr_pipeline.evaluation import char_error_rate, lines_to_text, load_samples
+from htr_pipeline.word_detector.scale import estimate_scale
+
+
+def evaluate(samples, scale_of, repeat: int) -> dict:
+    """Read all samples, scale_of(sample) gives the detector scale to use for a sample."""
+    read_page(samples[0].img, DetectorConfig(scale_of(samples[0])))  # warm up
+
+    texts = {}
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for sample in samples:
+            read_lines = read_page(sample.img, DetectorConfig(scale_of(sample), sample.margin),
+                                   LineClusteringConfig(min_words_per_line=1))
+            texts[sample.name] = lines_to_text(read_lines)
+    duration = time.perf_counter() - start_time
+
+    scales = [estimate_scale(s.img) if scale_of(s) == 'auto' else scale_of(s) for s in samples]
+    return {
+        'pages_per_second': len(samples) * repeat / duration,
+        'mean_scale': float(np.mean(scales)),
+        'mean_megapixels': float(np.mean([s.img.size * scale ** 2 / 1e6 for s, scale in zip(samples, scales)])),
+        'cer': float(np.mean([char_error_rate(texts[s.name], s.gt_text) for s in samples])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', required=True, help='directory with sample pages and ground truth texts')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.4, 0.3, 0.25])
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples)
+    if not samples:
+        raise SystemExit(f'No sample pages with ground truth text found in {args.samples}.')
+
+    settings = {f'fixed {scale}': (lambda s, scale=scale: scale) for scale in args.scales}
+    settings['config.json'] = lambda s: s.scale
+    settings['auto'] = lambda s: 'auto'
+
+    t = time.perf_counter()
+    for sample in samples:
+        estimate_scale(sample.img)
+    print(f'scale estimation: {(time.perf_counter() - t) / len(samples) * 1000:.1f} ms per page')
+
+    print(f'{"setting":<12} {"pages/s":>8} {"scale":>6} {"Mpx":>6} {"CER":>7}')
+    for name, scale_of in settings.items():
+        r = evaluate(samples, scale_of, args.repeat)
+        print(f'{name:<12} {r["pages_per_second"]:8.2f} {r["mean_scale"]:6.2f} {r["mean_megapixels"]:6.2f} '
+              f'{r["cer"]:7.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Compare the word beam search (ctc_single_word_beam_search) with the previous, object-based implementation.
+
+The reference below is the implementation the array-based beam search replaced: one Beam object per extension,
+probabilities as products (float32, like the model output), a dict-based prefix tree walked from the root. Both decode
+a randomized regression corpus of reader-like outputs (see benchmarks.suite.synthetic_predictions) of dictionary
+words, misspelled words and unrelated words, plus pure noise, with several beam widths. The decoded texts must be
+identical; the runtime of both is reported.
+
+Known difference: on long or noisy inputs, the float32 products of the reference underflow to 0, then its choice among
+the beams of probability 0 depends on their order, while the log-space implementation still ranks them. Mismatches
+where the best word beam of the reference has probability 0 are therefore reported separately, and only other
+mismatches count as failures.
+
+Usage: python -m benchmarks.beam_search [--batches 200] [--batch-size 8] [--dictionary-size 2000]
+"""
+import argparse
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+import numpy as np
+
+from benchmarks.suite import CHARS, WORDS_PATH, synthetic_predictions
+from htr_pipeline.reader.ctc import PrefixTree, ctc_single_word_beam_search
+
+
+@dataclass
+class _Node:
+    children: dict = field(default_factory=dict)
+    is_word: bool = False
+
+
+class _ReferenceTree:
+    """Dict-based prefix tree of the reference implementation."""
+
+    def __init__(self, words: List[str]):
+        self.root = _Node()
+        for word in words:
+            node = self.root
+            for c in word:
+                node = node.children.setdefault(c, _Node())
+            if word:
+                node.is_word = True
+
+    def _get_node(self, text: str):
+        node = self.root
+        for c in text:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        return node
+
+    def is_word(self, text: str) -> bool:
+        node = self._get_node(text)
+        return node.is_word if node else False
+
+    def get_next_chars(self, text: str) -> List[str]:
+        node = self._get_node(text)
+        return list(node.children) if node else []
+
+
+@dataclass
+class _Beam:
+    text: str
+    prob_blank: float
+    prob_non_blank: float
+
+    @property
+    def prob_total(self) -> float:
+        return self.prob_blank + self.prob_non_blank
+
+
+def reference_beam_search(predictions: np.ndarray,
+                          chars: List[str],
+                          beam_width: int,
+                          prefix_tree: _ReferenceTree) -> List[Tuple[str, float]]:
+    """Previous implementation, returns the text and the probability of the best word beam per batch element."""
+    res = []
+    for batch_idx in range(predictions.shape[1]):
+        prev = [_Beam('', 1, 0)]
+        for time_idx in range(predictions.shape[0]):
+            curr = []
+            for beam in sorted(prev, key=lambda x: x.prob_total, reverse=True)[:beam_width]:
+                pr_non_blank = 0
+                if beam.text != '':
+                    label_idx = chars.index(beam.text[-1]) + 1
+                    pr_non_blank = beam.prob_non_blank * predictions[time_idx, batch_idx, label_idx]
+                pr_blank = beam.prob_total * predictions[time_idx, batch_idx, 0]
+                curr.append(_Beam(beam.text, pr_blank, pr_non_blank))
+
+                for c in prefix_tree.get_next_chars(beam.text):
+                    label_idx = chars.index(c) + 1
+                    if beam.text != '' and beam.text[-1] == c:
+                        pr_non_blank = predictions[time_idx, batch_idx, label_idx] * beam.prob_blank
+                    else:
+                        pr_non_blank = predictions[time_idx, batch_idx, label_idx] * beam.prob_total
+                    curr.append(_Beam(beam.text + c, 0, pr_non_blank))
+            prev = curr
+
+        words = sorted([beam for beam in prev if prefix_tree.is_word(beam.text)], key=lambda x: x.prob_total,
+                       reverse=True)
+        res.append((words[0].text, float(words[0].prob_total)) if words else ('', 0.0))
+    return res
+
+
+def make_corpus(num_batches: int, batch_size: int, dictionary: List[str], seed: int = 0):
+    """Batches of (predictions, beam width): outputs for dictionary words, misspelled words, unrelated words and pure
+    noise of random length."""
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(num_batches):
+        kind = i % 4
+        beam_width = int(rng.choice([1, 5, 25]))
+        if kind == 3:
+            num_timesteps = int(rng.integers(4, 20))
+            logits = rng.normal(0, 2, (num_timesteps, batch_size, len(CHARS) + 1))
+            logits = np.exp(logits - logits.max(axis=2, keepdims=True))
+            corpus.append(((logits / logits.sum(axis=2, keepdims=True)).astype(np.float32), beam_width))
+            continue
+
+        words = list(rng.choice(dictionary, batch_size))
+        if kind == 1:  # one char replaced
+            words = [w[:k] + rng.choice(list('abcdefghijklmnopqrstuvwxyz')) + w[k + 1:]
+                     for w, k in ((w, int(rng.integers(len(w)))) for w in words)]
+        elif kind == 2:  # words of the model alphabet that are not in the dictionary
+            words = [''.join(rng.choice(CHARS[1:], int(rng.integers(1, 10)))) for _ in words]
+        predictions = synthetic_predictions(words, rng, int(rng.integers(2, 6)), noise=0.5, blank_logit=5.0)
+        corpus.append((predictions, beam_width))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--dictionary-size', type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(WORDS_PATH) as f:
+        words = [word.strip() for word in f if word.strip()]
+    dictionary = list(np.random.default_rng(1).choice(words, args.dictionary_size, replace=False))
+    prefix_tree, reference_tree = PrefixTree(dictionary), _ReferenceTree(dictionary)
+    corpus = make_corpus(args.batches, args.batch_size, dictionary)
+
+    num_decodes = num_underflow = 0
+    mismatches = []
+    time_new = time_ref = 0.0
+    for batch_idx, (predictions, beam_width) in enumerate(corpus):
+        t = time.perf_counter()
+        texts = ctc_single_word_beam_search(predictions, CHARS, beam_width, prefix_tree)
+        time_new += time.perf_counter() - t
+        t = time.perf_counter()
+        expected = reference_beam_search(predictions, CHARS, beam_width, reference_tree)
+        time_ref += time.perf_counter() - t
+
+        num_decodes += len(texts)
+        for b, (text, (ref_text, ref_prob)) in enumerate(zip(texts, expected)):
+            if text == ref_text:
+                continue
+            if ref_prob == 0:
+                num_underflow += 1
+            else:
+                mismatches.append((batch_idx, b, beam_width, text, ref_text))
+
+    print(f'{num_decodes} decodes in {len(corpus)} batches: {len(mismatches)} mismatches, '
+          f'{num_underflow} differences where the reference probabilities underflow to 0')
+    print(f'time per batch: {time_new / len(corpus) * 1000:.2f} ms (arrays, log space), '
+          f'{time_ref / len(corpus) * 1000:.2f} ms (reference)')
+    for batch_idx, b, beam_width, text, ref_text in mismatches[:20]:
+        print(f'  batch {batch_idx} element {b} (beam width {beam_width}): {text!r} != {ref_text!r}')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compare the box merging of the word detector with clustering the boxes by sklearn's DBSCAN.
+
+Boxes are generated like the detector output: every word produces a group of jittered boxes. For each size, the
+runtime and the peak memory (tracemalloc) of the merging by connected components of the sparse neighbor graph
+(cluster_boxes) and of DBSCAN on a dense and on a sparse precomputed distance matrix are reported, and the merged boxes
+are checked to be identical.
+
+Usage: python -m benchmarks.box_merging [--sizes 1000 10000 50000] [--max-dense 10000]
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from htr_pipeline.word_detector.aabb import AABBArray
+from htr_pipeline.word_detector.aabb_clustering import cluster_boxes
+from htr_pipeline.word_detector.iou import compute_iou_mat, compute_sparse_dist_mat
+
+
+def make_boxes(num_boxes: int, boxes_per_word: int = 20, seed: int = 0) -> AABBArray:
+    """Random detector-like boxes: words on a page with several noisy box predictions each, plus some outliers."""
+    rng = np.random.default_rng(seed)
+    num_words = max(num_boxes // boxes_per_word, 1)
+    cols = int(np.ceil(np.sqrt(num_words)))
+    word = np.arange(num_words)
+    cx = (word % cols) * 120 + rng.uniform(40, 80, num_words)
+    cy = (word // cols) * 60 + rng.uniform(20, 40, num_words)
+    w = rng.uniform(40, 100, num_words)
+    h = rng.uniform(20, 40, num_words)
+
+    idx = rng.integers(0, num_words, num_boxes)
+    jitter = rng.normal(0, 0.1, (4, num_boxes))
+    boxes = np.stack([cx[idx] - w[idx] / 2 * (1 + jitter[0]),
+                      cx[idx] + w[idx] / 2 * (1 + jitter[1]),
+                      cy[idx] - h[idx] / 2 * (1 + jitter[2]),
+                      cy[idx] + h[idx] / 2 * (1 + jitter[3])])
+    return AABBArray(np.round(boxes))
+
+
+def cluster_dbscan(aabbs: AABBArray, dense: bool) -> AABBArray:
+    """Reference: DBSCAN(eps=0.7, min_samples=3) on a precomputed Jaccard distance matrix."""
+    if dense:
+        dists = 1 - compute_iou_mat(aabbs.boxes, aabbs.boxes)
+    else:
+        dists = compute_sparse_dist_mat(aabbs.boxes, max_dist=0.7)
+    labels = DBSCAN(eps=0.7, min_samples=3, metric='precomputed').fit(dists).labels_
+    return aabbs.median_per_cluster(labels)
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    t = time.perf_counter()
+    res = fn(*args)
+    dt = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, dt, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--max-dense', type=int, default=10000, help='largest size for the dense DBSCAN reference')
+    args = parser.parse_args()
+
+    print(f'{"boxes":>7} {"method":<16} {"seconds":>8} {"peak MB":>9} {"clusters":>9}  identical')
+    for size in args.sizes:
+        aabbs = make_boxes(size)
+        merged, dt, peak = measure(cluster_boxes, aabbs)
+        print(f'{size:>7} {"sparse graph":<16} {dt:8.3f} {peak:9.1f} {len(merged):>9}')
+
+        for name, dense in (('DBSCAN dense', True), ('DBSCAN sparse', False)):
+            if dense and size > args.max_dense:
+                continue
+            ref, dt, peak = measure(cluster_dbscan, aabbs, dense)
+            identical = len(ref) == len(merged) and np.array_equal(ref.data, merged.data)
+            print(f'{size:>7} {name:<16} {dt:8.3f} {peak:9.1f} {len(ref):>9}  {identical}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Check and time the line clustering of sort_multiline against the previous DBSCAN implementation.
+
+Random pages (words on slanted, overlapping lines plus outliers, also with zero height words) are clustered by both
+implementations for several values of max_dist and min_words_per_line, the resulting lines must be identical.
+Afterwards both are timed on pages with growing numbers of words. The exit status is 1 if any page differs.
+
+Usage: python -m benchmarks.line_clustering [--pages 500] [--sizes 100 500 2000]
+"""
+import argparse
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from htr_pipeline.word_detector import AABB, DetectorRes, _cluster_lines
+
+
+def cluster_lines_dbscan(detections, max_dist=0.7, min_words_per_line=2):
+    """Reference: the previous implementation (quadratic distance matrix and DBSCAN)."""
+    num_bboxes = len(detections)
+    dist_mat = np.ones((num_bboxes, num_bboxes))
+    for i in range(num_bboxes):
+        for j in range(i, num_bboxes):
+            a = detections[i].aabb
+            b = detections[j].aabb
+            if a.ymin > b.ymax or b.ymin > a.ymax:
+                continue
+            intersection = min(a.ymax, b.ymax) - max(a.ymin, b.ymin)
+            union = a.height + b.height - intersection
+            iou = np.clip(intersection / union if union > 0 else 0, 0, 1)
+            dist_mat[i, j] = dist_mat[j, i] = 1 - iou
+
+    dbscan = DBSCAN(eps=max_dist, min_samples=min_words_per_line, metric='precomputed').fit(dist_mat)
+
+    clustered = defaultdict(list)
+    for i, cluster_id in enumerate(dbscan.labels_):
+        if cluster_id == -1:
+            continue
+        clustered[cluster_id].append(detections[i])
+
+    return sorted(clustered.values(), key=lambda line: [det.aabb.ymin + det.aabb.height / 2 for det in line])
+
+
+def make_detections(num_words: int, rng: np.random.Generator):
+    """Random words on lines of a page, the lines are slanted and may overlap, some words are outliers."""
+    words_per_line = rng.integers(1, 15)
+    line_height = rng.integers(10, 60)
+    res = []
+    for k in range(num_words):
+        line, pos = divmod(k, words_per_line)
+        y = line * line_height * rng.uniform(0.6, 1.2) + pos * rng.uniform(-3, 3)
+        h = 0 if rng.random() < 0.02 else rng.integers(line_height // 2, line_height * 2)
+        if rng.random() < 0.05:
+            y = rng.uniform(0, line_height * (num_words // words_per_line + 1))
+        x = pos * 100
+        res.append(DetectorRes(None, AABB(x, x + 80, int(y), int(y) + h)))
+    return [res[i] for i in rng.permutation(num_words)]
+
+
+def same_lines(lines1, lines2):
+    return [[id(det) for det in line] for line in lines1] == [[id(det) for det in line] for line in lines2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=500, help='number of random pages for the equivalence check')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 2000])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    mismatches = 0
+    for _ in range(args.pages):
+        detections = make_detections(int(rng.integers(1, 120)), rng)
+        max_dist = float(rng.choice([0.1, 0.3, 0.5, 0.7, 0.9, 1.0]))
+        min_words_per_line = int(rng.integers(1, 5))
+        mismatches += not same_lines(_cluster_lines(detections, max_dist, min_words_per_line),
+                                     cluster_lines_dbscan(detections, max_dist, min_words_per_line))
+    print(f'equivalence: {mismatches} of {args.pages} random pages differ')
+
+    print(f'{"words":>6} {"sweep s":>9} {"DBSCAN s":>9}')
+    for size in args.sizes:
+        detections = make_detections(size, rng)
+        t = time.perf_counter()
+        _cluster_lines(detections)
+        dt_sweep = time.perf_counter() - t
+        t = time.perf_counter()
+        cluster_lines_dbscan(detections)
+        dt_dbscan = time.perf_counter() - t
+        print(f'{size:>6} {dt_sweep:9.4f} {dt_dbscan:9.4f}')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
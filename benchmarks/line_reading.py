@@ -0,0 +1,83 @@
+"""Inference calls and accuracy of line-level reading compared to word-level reading.
+
+Every page is read with ReaderConfig(granularity='word') and granularity='line'. For each setting, pages/s, the number
+of reader inference calls and reader input megapixels per page, and the character error rate are reported, as well as
+the fraction of words read identically in both modes. Pages are the synthetic pages of benchmarks.synthetic, or the
+sample pages of a directory (image plus ground truth .txt, see htr_pipeline.evaluation.load_samples).
+
+Usage: python -m benchmarks.line_reading [--samples DIR] [--scale auto] [--batch-size 64] [--repeat 1]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.suite import models_available
+from benchmarks.synthetic import PAGE_SIZES, WORD_DENSITIES, make_page
+from htr_pipeline import DetectorConfig, LineClusteringConfig, PipelineStats, ReaderConfig, profile, read_page
+from htr_pipeline.evaluation import char_error_rate, lines_to_text, load_samples
+
+
+def evaluate(pages, detector_config: DetectorConfig, reader_config: ReaderConfig, repeat: int) -> dict:
+    """Read all pages (list of (image, ground truth text)), returns the measurements and the read words."""
+    line_clustering_config = LineClusteringConfig(min_words_per_line=1)
+    read_page(pages[0][0], detector_config, line_clustering_config, reader_config)  # warm up
+
+    results = []
+    start_time = time.perf_counter()
+    with profile(PipelineStats()) as stats:
+        for _ in range(repeat):
+            results = [read_page(img, detector_config, line_clustering_config, reader_config) for img, _ in pages]
+    duration = time.perf_counter() - start_time
+
+    forward = stats.summary()['read.forward']
+    num_pixels = sum(np.prod([int(d) for d in shape.split('x')]) * n for shape, n in forward['shapes'].items())
+    num_pages = len(pages) * repeat
+    return {
+        'pages_per_second': num_pages / duration,
+        'calls_per_page': forward['calls'] / num_pages,
+        'megapixels_per_page': num_pixels / num_pages / 1e6,
+        'cer': float(np.mean([char_error_rate(lines_to_text(read_lines), gt_text)
+                              for read_lines, (_, gt_text) in zip(results, pages)])),
+        'words': [word.text for read_lines in results for line in read_lines for word in line],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', help='directory with sample pages and ground truth texts (default: synthetic)')
+    parser.add_argument('--scale', default='auto', help="detector scale, or 'auto'")
+    parser.add_argument('--decoder', choices=['best_path', 'word_beam_search', 'auto'], default='best_path')
+    parser.add_argument('--batch-size', type=int, default=64, help='words (or lines) per inference call')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if not models_available():
+        raise SystemExit('Models not found.')
+
+    if args.samples:
+        pages = [(sample.img, sample.gt_text) for sample in load_samples(args.samples)]
+        if not pages:
+            raise SystemExit(f'No sample pages with ground truth text found in {args.samples}.')
+    else:
+        pages = []
+        for seed, (size, density) in enumerate((size, density) for size in PAGE_SIZES for density in WORD_DENSITIES):
+            page = make_page(size, density, seed=seed)
+            pages.append((page.img, page.text))
+
+    detector_config = DetectorConfig(scale=args.scale if args.scale == 'auto' else float(args.scale))
+    results = {granularity: evaluate(pages, detector_config,
+                                     ReaderConfig(args.decoder, batch_size=args.batch_size, granularity=granularity),
+                                     args.repeat)
+               for granularity in ('word', 'line')}
+
+    print(f'{"granularity":<12} {"pages/s":>8} {"calls/page":>11} {"Mpx/page":>9} {"CER":>7}')
+    for name, r in results.items():
+        print(f'{name:<12} {r["pages_per_second"]:8.2f} {r["calls_per_page"]:11.1f} {r["megapixels_per_page"]:9.2f} '
+              f'{r["cer"]:7.4f}')
+    same = np.mean([a == b for a, b in zip(results['word']['words'], results['line']['words'])])
+    print(f'words read identically in both modes: {same:.1%} of {len(results["word"]["words"])}')
+
+
+if __name__ == '__main__':
+    main()
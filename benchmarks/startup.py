@@ -0,0 +1,56 @@
+"""Measure import time and memory of the entry points of the web and worker processes.
+
+Each target is imported in a fresh interpreter, so the numbers include everything the import pulls in.
+
+Usage: python -m benchmarks.startup [--repeat 3]
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+_SNIPPET = '''
+import json, resource, time
+t = time.perf_counter()
+{code}
+dt = time.perf_counter() - t
+mods = __import__('sys').modules
+print(json.dumps({{'seconds': dt,
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'onnxruntime': 'onnxruntime' in mods,
+                  'torch': 'torch' in mods}}))
+'''
+
+TARGETS = {
+    'web app (create_app)': 'from app import create_app; create_app()',
+    'task module': 'import app.tasks',
+    'htr_pipeline import': 'import htr_pipeline',
+    'htr_pipeline warmup': 'import htr_pipeline; htr_pipeline.warmup()',
+}
+
+
+def measure(code: str) -> dict:
+    out = subprocess.run([sys.executable, '-c', _SNIPPET.format(code=code)],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"target":<24} {"seconds":>8} {"rss MB":>8}  onnxruntime  torch')
+    for name, code in TARGETS.items():
+        try:
+            runs = [measure(code) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f'{name:<24} failed: {e.stderr.strip().splitlines()[-1]}')
+            continue
+        best = min(runs, key=lambda r: r['seconds'])
+        print(f'{name:<24} {best["seconds"]:8.3f} {best["max_rss_mb"]:8.1f}  {str(best["onnxruntime"]):<11}  '
+              f'{best["torch"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Benchmark suite of the hot paths of htr_pipeline, with JSON output that can be compared against a baseline.
+
+Microbenchmarks run on synthetic pages (see benchmarks.synthetic) and synthetic model outputs, so they do not need the
+models. The end-to-end benchmarks run read_page on synthetic pages of several sizes and word densities, they are
+skipped if the models are not available. Everything runs offline on the CPU.
+
+Usage:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json --tolerance 0.2 [--fail-on-regression]
+    python -m benchmarks.suite --quick --only micro/
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from pkg_resources import resource_filename
+
+from benchmarks.synthetic import PAGE_SIZES, WORD_DENSITIES, make_page
+from htr_pipeline import DetectorConfig, LineClusteringConfig, PipelineStats, profile, read_page
+from htr_pipeline.evaluation import char_error_rate, lines_to_text
+from htr_pipeline.reader import _decode, transform
+from htr_pipeline.reader.ctc import PrefixTree, ctc_best_path, ctc_single_word_beam_search
+from htr_pipeline.word_detector import AABB, DetectorRes, _cluster_lines
+from htr_pipeline.word_detector.coding import MapOrdering, decode, encode, fg_by_cc
+from htr_pipeline.word_detector.iou import compute_dist_mat
+
+# fixed alphabet for the synthetic reader outputs (label 0 is the CTC blank)
+CHARS = list(' !"#&\'()*+,-./0123456789:;?ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+
+WORDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'words_alpha.txt')
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Call fn once for warm up, then repeat times, returns median and minimum seconds per call."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': repeat}
+
+
+def synthetic_predictions(words: List[str],
+                          rng: np.random.Generator,
+                          steps_per_char: int = 4,
+                          noise: float = 1.0,
+                          blank_logit: float = 3.0) -> np.ndarray:
+    """Reader-like output (WxBxC softmax) for the given words: each char is predicted for a few time-steps, separated by
+    blanks, with random noise (standard deviation of the logits)."""
+    num_timesteps = max(len(word) for word in words) * steps_per_char + 8
+    logits = rng.normal(0, noise, (num_timesteps, len(words), len(CHARS) + 1))
+    logits[..., 0] += blank_logit
+    label = {c: i + 1 for i, c in enumerate(CHARS)}
+    for b, word in enumerate(words):
+        for k, c in enumerate(word):
+            t = 4 + k * steps_per_char
+            logits[t:t + steps_per_char - 1, b, label[c]] += 8
+    logits = np.exp(logits - logits.max(axis=2, keepdims=True))
+    return (logits / logits.sum(axis=2, keepdims=True)).astype(np.float32)
+
+
+def micro_benchmarks(quick: bool) -> Dict[str, Callable[[], object]]:
+    """Named functions running one hot path each, on inputs prepared here."""
+    rng = np.random.default_rng(0)
+    page = make_page('small' if quick else 'medium', 'dense', seed=0)
+    h, w = page.img.shape
+    gt_aabbs = [AABB(*box) for box in page.boxes]
+    crops = [page.img[ymin:ymax, xmin:xmax] for xmin, xmax, ymin, ymax in page.boxes]
+
+    # detector output as the model would predict it (at half the input resolution)
+    pred_map = encode((h // 2, w // 2), gt_aabbs, 0.5)
+    seg_map = pred_map[MapOrdering.SEG_WORD]
+    aabbs = decode(pred_map, comp_fg=fg_by_cc(0.5, 100), f=2)
+    detections = [DetectorRes(None, aabb) for aabb in gt_aabbs]
+
+    words = page.text.split()
+    predictions = synthetic_predictions(words[:64], rng)
+    clean_predictions = synthetic_predictions(words[:64], rng, noise=0.3, blank_logit=6.0)  # confidently read
+    with open(WORDS_PATH) as f:
+        dictionary = [word.strip() for word in f]
+    if quick:
+        dictionary = dictionary[::20]
+    prefix_tree = PrefixTree(dictionary + words)
+
+    return {
+        'micro/transform': lambda: [transform(crop) for crop in crops],
+        'micro/decode': lambda: decode(pred_map, comp_fg=fg_by_cc(0.5, 100), f=2),
+        'micro/fg_by_cc': lambda: fg_by_cc(0.5, 100)(seg_map),
+        'micro/compute_dist_mat': lambda: compute_dist_mat(aabbs),
+        'micro/cluster_lines': lambda: _cluster_lines(detections, 0.7, 1),
+        'micro/ctc_best_path': lambda: ctc_best_path(predictions, CHARS),
+        'micro/ctc_word_beam_search': lambda: ctc_single_word_beam_search(predictions, CHARS, 25, prefix_tree),
+        'micro/ctc_auto': lambda: _decode(clean_predictions, 'auto', prefix_tree, CHARS),
+        'micro/prefix_tree_build': lambda: PrefixTree(dictionary),
+    }
+
+
+def models_available() -> bool:
+    return all(os.path.exists(resource_filename('htr_pipeline', f'models/{name}'))
+               for name in ('detector.onnx', 'reader.onnx', 'reader.json'))
+
+
+def end_to_end_benchmarks(quick: bool, repeat: int) -> Dict[str, dict]:
+    """read_page throughput on synthetic pages, with the time spent in each stage."""
+    sizes = ['small'] if quick else list(PAGE_SIZES)
+    res = {}
+    for size in sizes:
+        for density in WORD_DENSITIES:
+            page = make_page(size, density, seed=1)
+            detector_config = DetectorConfig(scale='auto')
+            line_clustering_config = LineClusteringConfig(min_words_per_line=1)
+            read_lines = read_page(page.img, detector_config, line_clustering_config)  # warm up
+
+            with profile(PipelineStats()) as stats:
+                r = measure(lambda: read_page(page.img, detector_config, line_clustering_config), repeat)
+            r.update({'pages_per_second': 1 / r['median'],
+                      'words': len(page.boxes),
+                      'cer': char_error_rate(lines_to_text(read_lines), page.text),
+                      'stages': {name: s['seconds'] / s['calls'] for name, s in stats.summary().items()}})
+            res[f'e2e/read_page/{size}/{density}'] = r
+    return res
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Print the change of the median times against the baseline, returns the names of the regressions."""
+    regressions = []
+    print(f'\n{"benchmark":<40} {"baseline ms":>12} {"current ms":>11} {"change":>8}')
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median'], r['median']
+        change = after / before - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<40} {before * 1000:12.3f} {after * 1000:11.3f} {change:+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='write the results (JSON) to this file')
+    parser.add_argument('--baseline', help='results (JSON) of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--quick', action='store_true', help='smaller inputs and only small pages')
+    parser.add_argument('--only', default='', help='only run benchmarks whose name starts with this prefix')
+    parser.add_argument('--no-e2e', action='store_true', help='skip the end-to-end benchmarks')
+    args = parser.parse_args()
+
+    results = {}
+    print(f'{"benchmark":<40} {"median ms":>10} {"min ms":>10}')
+    for name, fn in micro_benchmarks(args.quick).items():
+        if name.startswith(args.only):
+            results[name] = measure(fn, args.repeat)
+            print(f'{name:<40} {results[name]["median"] * 1000:10.3f} {results[name]["min"] * 1000:10.3f}')
+
+    if not args.no_e2e and ('e2e/'.startswith(args.only) or args.only.startswith('e2e/')):
+        if models_available():
+            for name, r in end_to_end_benchmarks(args.quick, max(1, args.repeat // 3)).items():
+                if name.startswith(args.only):
+                    results[name] = r
+                    print(f'{name:<40} {r["median"] * 1000:10.3f} {r["min"] * 1000:10.3f}  '
+                          f'{r["pages_per_second"]:.2f} pages/s, CER {r["cer"]:.3f}')
+        else:
+            print('models not found, skipping the end-to-end benchmarks')
+
+    report = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                 'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'quick': args.quick,
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('quick') != args.quick:
+            print('warning: baseline was run with a different --quick setting')
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Synthetic handwritten-like pages rendered with the script fonts of OpenCV.
+
+Pages are deterministic for a given seed, so benchmark runs are comparable. Each page comes with its ground truth:
+the text (lines separated by newlines) and the bounding box of every word.
+"""
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+PAGE_SIZES = {
+    'small': (1200, 900),
+    'medium': (2400, 1700),
+    'a4_300dpi': (3508, 2480),
+}
+
+# word spacing (in units of the font height) and line spacing (in units of the font height)
+WORD_DENSITIES = {
+    'sparse': (1.5, 3.0),
+    'normal': (0.8, 2.0),
+    'dense': (0.4, 1.4),
+}
+
+_FONTS = (cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, cv2.FONT_HERSHEY_SCRIPT_COMPLEX)
+
+_WORDS = ('the', 'answer', 'is', 'energy', 'cell', 'force', 'because', 'water', 'light', 'plant', 'mass', 'of',
+          'and', 'reaction', 'carbon', 'oxygen', 'speed', 'heat', 'rate', 'gravity', 'system', 'which', 'when', 'a',
+          'process', 'example', 'therefore', 'increases', 'molecule', 'current', 'Newton', 'Earth', 'Sun', 'DNA')
+
+
+@dataclass
+class SyntheticPage:
+    img: np.ndarray  # grayscale uint8, black text on white paper
+    text: str  # ground truth, words separated by spaces and lines by newlines
+    boxes: List[Tuple[int, int, int, int]]  # (xmin, xmax, ymin, ymax) of each word, in reading order
+
+
+def make_page(size: str = 'small', density: str = 'normal', text_height: int = 40, seed: int = 0) -> SyntheticPage:
+    """Render a page of random words.
+
+    Args:
+        size: Page size, one of PAGE_SIZES.
+        density: Spacing of words and lines, one of WORD_DENSITIES.
+        text_height: Approximate height of the letters in pixels.
+        seed: Seed of the random words, fonts and jitter.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = PAGE_SIZES[size]
+    word_spacing, line_spacing = WORD_DENSITIES[density]
+    img = np.full((h, w), 255, np.uint8)
+
+    margin = 2 * text_height
+    lines, boxes = [], []
+    y = margin
+    while y < h - margin:
+        x = margin
+        line = []
+        while True:
+            word = _WORDS[rng.integers(len(_WORDS))]
+            font = _FONTS[rng.integers(len(_FONTS))]
+            font_scale = text_height / 22 * rng.uniform(0.85, 1.15)  # script fonts are about 22 px high at scale 1
+            thickness = max(1, round(font_scale * rng.uniform(1.2, 2.0)))
+            (tw, th), baseline = cv2.getTextSize(word, font, font_scale, thickness)
+            if x + tw > w - margin:
+                break
+            yw = y + int(rng.normal(0, text_height * 0.08))
+            cv2.putText(img, word, (x, yw), font, font_scale, 0, thickness, cv2.LINE_AA)
+            line.append(word)
+            boxes.append((x, x + tw, yw - th, yw + baseline))
+            x += tw + int(text_height * word_spacing * rng.uniform(0.7, 1.3))
+        if line:
+            lines.append(' '.join(line))
+        y += int(text_height * line_spacing)
+
+    # paper texture and scanner noise
+    noise = rng.normal(0, 6, img.shape)
+    img = np.clip(img.astype(np.float64) + noise, 0, 255).astype(np.uint8)
+    return SyntheticPage(img, '\n'.join(lines), boxes)
@@ -1,26 +1,40 @@
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
 
 import cv2
 import numpy as np
 
-from .reader import read
+from .reader import DEFAULT_CONFIDENCE_THRESHOLD, read, read_batch, read_batch_with_confidences, read_line_batch
+from .reader import warmup as _warmup_reader
+from .profiling import PipelineStats, profile, stage
 from .reader.ctc import PrefixTree
-from .word_detector import detect, sort_multiline, AABB
+from .runtime import RuntimeConfig, configure_runtime, end_profiling, get_runtime_config
+from .word_detector import detect, detect_batch, sort_multiline, AABB, DetectorRes
+from .word_detector import warmup as _warmup_detector
 
 
 @dataclass
 class WordReadout:
-    """Information about a read word: the readout and the bounding box."""
+    """Information about a read word: the readout, the bounding box and the confidence of the model in the readout
+    (smallest probability of the time-steps of its best path)."""
     text: str
     aabb: AABB
+    confidence: float = 1.0
 
 
 @dataclass
 class DetectorConfig:
     """Configure size at which word detection is done, and define added margin around word before reading."""
-    scale: float = 1.0
+    scale: Union[float, str] = 1.0  # 'auto' estimates the scale per page from the height of the handwriting
     margin: int = 0
+    precision: str = 'fp32'  # 'fp32' or 'int8' (quantized model, see htr_pipeline.quantize)
+    batch_size: int = 1  # maximum number of pages detected in one inference call (read_pages), multiplies memory
+    tile_size: Optional[int] = None  # if set, detect on tiles of this size (pixels after scaling) to bound memory
+    tile_overlap: int = 256  # overlap of neighboring tiles, should exceed the size of the largest word
+    tile_workers: int = 1  # number of tiles processed concurrently
 
 
 @dataclass
@@ -33,30 +47,131 @@ class LineClusteringConfig:
 @dataclass
 class ReaderConfig:
     """Configure how the detected words are read."""
-    decoder: str = 'best_path'  # 'best_path' or 'word_beam_search'
+    decoder: str = 'best_path'  # 'best_path', 'word_beam_search' or 'auto' (beam search only for unsure words)
     prefix_tree: Optional[PrefixTree] = None
+    batch_size: int = 64  # maximum number of words (or lines) read in one inference call
+    precision: str = 'fp32'  # 'fp32' or 'int8' (quantized model, see htr_pipeline.quantize)
+    confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD  # 'auto' accepts best paths at least this confident
+    granularity: str = 'word'  # 'word' (one model input per word) or 'line' (the words of a line stitched together)
 
 
 def read_page(img: np.ndarray,
               detector_config: DetectorConfig = DetectorConfig(),
               line_clustering_config=LineClusteringConfig(),
               reader_config=ReaderConfig()) -> List[List[WordReadout]]:
-    """Read a page of handwritten words. Returns a list of lines. Each line is a list of read words."""
-    if img.ndim == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    """Read a page of handwritten words. Returns a list of lines. Each line is a list of read words.
 
-    # detect words
-    detections = detect(img, detector_config.scale, detector_config.margin)
+    Run inside `with profile() as stats:` to measure the time spent in each stage of the pipeline.
+    """
+    return read_pages([img], detector_config, line_clustering_config, reader_config)[0]
 
-    # sort words (cluster into lines and ensure reading order top->bottom and left->right)
-    lines = sort_multiline(detections, min_words_per_line=line_clustering_config.min_words_per_line)
 
-    # go through all lines and words and read all of them
-    read_lines = []
-    for line in lines:
-        read_lines.append([])
-        for word in line:
-            text = read(word.img, reader_config.decoder, reader_config.prefix_tree)
-            read_lines[-1].append(WordReadout(text, word.aabb))
+def _detect_lines(imgs: Sequence[np.ndarray],
+                  detector_config: DetectorConfig,
+                  line_clustering_config: LineClusteringConfig) -> List[List[List[DetectorRes]]]:
+    """Detect the words of the pages and cluster them into lines."""
+    imgs = [cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img for img in imgs]
 
-    return read_lines
+    # detect words
+    pages_detections = detect_batch(imgs, detector_config.scale, detector_config.margin, detector_config.precision,
+                                    detector_config.batch_size, detector_config.tile_size,
+                                    detector_config.tile_overlap, detector_config.tile_workers)
+
+    # sort words (cluster into lines and ensure reading order top->bottom and left->right)
+    return [sort_multiline(detections, min_words_per_line=line_clustering_config.min_words_per_line)
+            for detections in pages_detections]
+
+
+def _read_lines(pages_lines: List[List[List[DetectorRes]]],
+                reader_config: ReaderConfig) -> List[List[List[WordReadout]]]:
+    """Read the detected words of the pages, all words (or lines) are read in shared batches."""
+    if reader_config.granularity == 'word':
+        words = [word for lines in pages_lines for line in lines for word in line]
+        texts, confidences = read_batch_with_confidences([word.img for word in words],
+                                                         reader_config.decoder,
+                                                         reader_config.prefix_tree,
+                                                         reader_config.batch_size,
+                                                         precision=reader_config.precision,
+                                                         confidence_threshold=reader_config.confidence_threshold)
+    elif reader_config.granularity == 'line':
+        lines = [[word.img for word in line] for lines in pages_lines for line in lines]
+        lines_texts, lines_confidences = read_line_batch(lines,
+                                                         reader_config.decoder,
+                                                         reader_config.prefix_tree,
+                                                         reader_config.batch_size,
+                                                         precision=reader_config.precision,
+                                                         confidence_threshold=reader_config.confidence_threshold)
+        texts = [text for line_texts in lines_texts for text in line_texts]
+        confidences = [confidence for line_confidences in lines_confidences for confidence in line_confidences]
+    else:
+        raise Exception('Unknown granularity. Available: "word" and "line".')
+    readouts = iter(zip(texts, confidences))
+
+    res = []
+    for lines in pages_lines:
+        read_lines = []
+        for line in lines:
+            read_lines.append([])
+            for word in line:
+                text, confidence = next(readouts)
+                read_lines[-1].append(WordReadout(text, word.aabb, confidence))
+        res.append(read_lines)
+
+    return res
+
+
+def read_pages(imgs: Sequence[np.ndarray],
+               detector_config: DetectorConfig = DetectorConfig(),
+               line_clustering_config=LineClusteringConfig(),
+               reader_config=ReaderConfig()) -> List[List[List[WordReadout]]]:
+    """Read several pages of handwritten words, returns the result of read_page for each page.
+
+    The words of all pages are read in shared batches, which needs far fewer inference calls than reading the pages
+    one by one. Pages of the same size are also detected in shared batches if DetectorConfig.batch_size is above 1.
+    """
+    with stage('read_pages', items=len(imgs)):
+        return _read_lines(_detect_lines(imgs, detector_config, line_clustering_config), reader_config)
+
+
+def iter_read_pages(imgs: Iterable[np.ndarray],
+                    detector_config: DetectorConfig = DetectorConfig(),
+                    line_clustering_config=LineClusteringConfig(),
+                    reader_config=ReaderConfig(),
+                    num_detect_workers: int = 1,
+                    max_pending_pages: int = 2) -> Iterator[List[List[WordReadout]]]:
+    """Read pages in a pipeline, yields the result of read_page for each page (in order) as soon as it is ready.
+
+    Pages are detected by a pool of num_detect_workers threads, while the words of already detected pages are read
+    by another thread, so detection of the next page overlaps with reading of the current one (ONNX Runtime releases
+    the GIL). At most max_pending_pages pages are taken from imgs before their result has been yielded, which bounds
+    the memory used, and imgs may be a lazy iterator.
+    """
+    detect_pool = ThreadPoolExecutor(num_detect_workers, thread_name_prefix='htr-detect')
+    read_pool = ThreadPoolExecutor(1, thread_name_prefix='htr-read')
+
+    def read_when_detected(detect_future):
+        return _read_lines(detect_future.result(), reader_config)[0]
+
+    pending = deque()
+    try:
+        for img in imgs:
+            # the stages run in copies of the current context, so that profiling (see profile()) is kept
+            detect_future = detect_pool.submit(contextvars.copy_context().run, _detect_lines, [img], detector_config,
+                                               line_clustering_config)
+            pending.append(read_pool.submit(contextvars.copy_context().run, read_when_detected, detect_future))
+            if len(pending) >= max_pending_pages:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        detect_pool.shutdown(wait=True, cancel_futures=True)
+        read_pool.shutdown(wait=True, cancel_futures=True)
+
+
+def warmup(precision: str = 'fp32'):
+    """Load the detector and reader models (of the given precision) and run them once.
+
+    Models are otherwise loaded on first use, so importing the package is cheap.
+    """
+    _warmup_detector(precision)
+    _warmup_reader(precision)
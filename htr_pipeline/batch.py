@@ -0,0 +1,190 @@
+"""Read many pages offline with a pool of worker processes and write the results as JSON lines.
+
+The pages are decoded in the main process and handed to the workers in shared memory (multiprocessing.shared_memory),
+so no image data is pickled. Every worker process creates its own ONNX Runtime sessions on first use. Each line of the
+output file holds the result of one page: {"path": ..., "lines": [[{"text": ..., "aabb": [xmin, xmax, ymin, ymax],
+"confidence": ...}, ...], ...]}, or {"path": ..., "error": ...} if the page could not be read. Lines are written in
+completion order.
+
+Usage:
+    python -m htr_pipeline.batch scans/*.png --output results.jsonl --workers 8 --scale auto
+"""
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from . import DetectorConfig, LineClusteringConfig, ReaderConfig, read_page
+from .reader.ctc import PrefixTree
+from .runtime import RuntimeConfig, configure_runtime
+
+# configs of the pipeline in a worker process, set by the pool initializer
+_worker_configs: Optional[Tuple[DetectorConfig, LineClusteringConfig, ReaderConfig]] = None
+
+
+def _init_worker(runtime_config: RuntimeConfig,
+                 detector_config: DetectorConfig,
+                 line_clustering_config: LineClusteringConfig,
+                 reader_config: ReaderConfig,
+                 trie_path: Optional[str]):
+    global _worker_configs
+    configure_runtime(runtime_config)
+    if trie_path is not None:
+        reader_config.prefix_tree = PrefixTree.load(trie_path)
+    _worker_configs = detector_config, line_clustering_config, reader_config
+
+
+def _read_shared_page(shm_name: str, shape: Tuple[int, ...]) -> list:
+    """Read the page stored in the shared memory block, returns the lines as JSON serializable lists."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    error = None
+    try:
+        read_lines = read_page(np.ndarray(shape, np.uint8, shm.buf), *_worker_configs)
+    except Exception as e:
+        # only keep the message, the traceback references the image in shared memory, which must be released
+        error = f'{type(e).__name__}: {e}'
+    shm.close()
+    if error is not None:
+        raise RuntimeError(error)
+
+    return [[{'text': word.text, 'aabb': [int(word.aabb.xmin), int(word.aabb.xmax),
+                                          int(word.aabb.ymin), int(word.aabb.ymax)],
+              'confidence': word.confidence}
+             for word in line] for line in read_lines]
+
+
+def run_batch(image_paths: Sequence[str],
+              output_path: str,
+              detector_config: DetectorConfig = DetectorConfig(),
+              line_clustering_config: LineClusteringConfig = LineClusteringConfig(),
+              reader_config: ReaderConfig = ReaderConfig(),
+              trie_path: Optional[str] = None,
+              num_workers: Optional[int] = None,
+              threads_per_worker: Optional[int] = None,
+              report_interval: float = 10.0,
+              report: Callable[[str], None] = print) -> dict:
+    """Read the pages with a pool of worker processes and write one JSON line per page to output_path.
+
+    Args:
+        image_paths: Paths of the page images.
+        output_path: File the JSON lines are written to.
+        detector_config, line_clustering_config, reader_config: Configuration of read_page. The prefix tree of the
+            reader config is not sent to the workers, use trie_path instead.
+        trie_path: Compiled prefix tree (see PrefixTree.save), memory-mapped by every worker.
+        num_workers: Number of worker processes, defaults to the number of CPUs.
+        threads_per_worker: ONNX Runtime intra-op threads per worker, defaults to CPUs / workers.
+        report_interval: Seconds between progress reports.
+        report: Function called with the progress reports.
+
+    Returns:
+        Summary with the number of pages, failed pages, duration and pages per second.
+    """
+    num_workers = num_workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // num_workers)
+    runtime_config = RuntimeConfig(intra_op_num_threads=threads_per_worker, allow_spinning=False)
+    worker_reader_config = dataclasses.replace(reader_config, prefix_tree=None)
+
+    # few more pages than workers are in flight, so that workers never wait while memory stays bounded
+    max_in_flight = 2 * num_workers
+    paths = iter(image_paths)
+    pending = {}
+    num_done = num_failed = 0
+    start_time = last_report = time.perf_counter()
+
+    def write(f, path, **result):
+        nonlocal num_done, num_failed
+        f.write(json.dumps({'path': path, **result}) + '\n')
+        num_done += 1
+        num_failed += 'error' in result
+
+    with open(output_path, 'w') as f, ProcessPoolExecutor(
+            num_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+            initargs=(runtime_config, detector_config, line_clustering_config, worker_reader_config, trie_path)) as pool:
+        try:
+            while True:
+                # decode pages into shared memory and submit them
+                for path in paths:
+                    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                    if img is None:
+                        write(f, path, error=f'Image not found or not decodable: {path}')
+                        continue
+                    shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+                    np.ndarray(img.shape, np.uint8, shm.buf)[:] = img
+                    pending[pool.submit(_read_shared_page, shm.name, img.shape)] = path, shm
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, shm = pending.pop(future)
+                    shm.close()
+                    shm.unlink()
+                    try:
+                        write(f, path, lines=future.result())
+                    except Exception as e:
+                        write(f, path, error=str(e))
+
+                now = time.perf_counter()
+                if now - last_report >= report_interval:
+                    report(f'{num_done} pages, {num_done / (now - start_time):.2f} pages/s')
+                    last_report = now
+        finally:
+            # release the shared memory of pages still in flight (on errors or interrupts)
+            for _, shm in pending.values():
+                shm.close()
+                shm.unlink()
+
+    duration = time.perf_counter() - start_time
+    summary = {'pages': num_done, 'failed': num_failed, 'seconds': duration,
+               'pages_per_second': num_done / duration if duration > 0 else 0.0}
+    report(f'{num_done} pages ({num_failed} failed) in {duration:.1f}s, {summary["pages_per_second"]:.2f} pages/s')
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read many pages with a pool of worker processes.')
+    parser.add_argument('images', nargs='+', help='page images')
+    parser.add_argument('--output', required=True, help='JSON lines file the results are written to')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--threads-per-worker', type=int, help='ONNX Runtime threads per worker')
+    parser.add_argument('--scale', default='1.0', help="detector scale, or 'auto'")
+    parser.add_argument('--margin', type=int, default=0)
+    parser.add_argument('--precision', choices=['fp32', 'int8'], default='fp32')
+    parser.add_argument('--decoder', choices=['best_path', 'word_beam_search', 'auto'], default='best_path')
+    parser.add_argument('--trie', help="compiled prefix tree (PrefixTree.save) for word beam search and 'auto'")
+    parser.add_argument('--confidence-threshold', type=float, default=ReaderConfig.confidence_threshold,
+                        help="confidence from which the 'auto' decoder accepts the best path")
+    parser.add_argument('--granularity', choices=['word', 'line'], default='word',
+                        help='read each word separately, or the words of a line stitched into one model input')
+    parser.add_argument('--min-words-per-line', type=int, default=1)
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress reports')
+    args = parser.parse_args()
+
+    scale = args.scale if args.scale == 'auto' else float(args.scale)
+    summary = run_batch(args.images,
+                        args.output,
+                        DetectorConfig(scale, args.margin, args.precision),
+                        LineClusteringConfig(min_words_per_line=args.min_words_per_line),
+                        ReaderConfig(args.decoder, precision=args.precision,
+                                     confidence_threshold=args.confidence_threshold, granularity=args.granularity),
+                        trie_path=args.trie,
+                        num_workers=args.workers,
+                        threads_per_worker=args.threads_per_worker,
+                        report_interval=args.report_interval,
+                        report=lambda msg: print(msg, file=sys.stderr))
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
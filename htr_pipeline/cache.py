@@ -0,0 +1,297 @@
+"""Content-addressed cache of read pages.
+
+Pages are identified by a hash of the image (encoded file bytes or decoded pixels) and of all settings that influence
+the result: detector, line clustering and reader config, and the dictionary if the decoder uses it. The read lines
+are stored in a compact binary form. Backends keep the most recently used entries up to a size limit.
+
+Usage:
+    cache = PageCache(MemoryBackend(max_bytes=64 * 2 ** 20))
+    key = cache.key(image_bytes, detector_config, line_clustering_config, reader_config)
+    read_lines = cache.get(key)
+    if read_lines is None:
+        read_lines = read_page(img, detector_config, line_clustering_config, reader_config)
+        cache.put(key, read_lines)
+"""
+import dataclasses
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+import numpy as np
+
+from . import DetectorConfig, LineClusteringConfig, ReaderConfig, WordReadout
+from .word_detector import AABBArray
+
+logger = logging.getLogger(__name__)
+
+# bump when the results of the pipeline change for the same settings, which invalidates all cached pages
+CACHE_VERSION = 4
+
+_MAGIC = b'HTRPAGE2'
+
+
+def serialize_lines(read_lines: List[List[WordReadout]]) -> bytes:
+    """Compact binary form of the lines of a page: line lengths and word boxes as int32 arrays, confidences as float64
+    array, then the texts."""
+    words = [word for line in read_lines for word in line]
+    line_lengths = np.array([len(line) for line in read_lines], np.int32)
+    boxes = np.array([[w.aabb.xmin, w.aabb.xmax, w.aabb.ymin, w.aabb.ymax] for w in words], np.int32).reshape(-1, 4)
+    confidences = np.array([word.confidence for word in words], np.float64)
+    texts = '\0'.join(word.text for word in words).encode('utf-8')
+    header = np.array([len(line_lengths), len(words)], np.uint32)
+    return b''.join([_MAGIC, header.tobytes(), line_lengths.tobytes(), boxes.tobytes(), confidences.tobytes(), texts])
+
+
+def deserialize_lines(data: bytes) -> List[List[WordReadout]]:
+    """Inverse of serialize_lines."""
+    if data[:8] != _MAGIC:
+        raise ValueError('Not a serialized page.')
+    num_lines, num_words = (int(n) for n in np.frombuffer(data, np.uint32, 2, 8))
+    offset = 16
+    line_lengths = np.frombuffer(data, np.int32, num_lines, offset)
+    offset += 4 * num_lines
+    boxes = np.frombuffer(data, np.int32, 4 * num_words, offset).reshape(num_words, 4)
+    offset += 16 * num_words
+    confidences = np.frombuffer(data, np.float64, num_words, offset)
+    offset += 8 * num_words
+    texts = data[offset:].decode('utf-8').split('\0') if num_words else []
+    if len(texts) != num_words or line_lengths.min(initial=0) < 0 or line_lengths.sum() != num_words:
+        raise ValueError('Corrupt serialized page.')
+
+    res = []
+    words = iter(zip(texts, AABBArray.from_boxes(boxes.astype(np.int64)), confidences.tolist()))
+    for line_length in line_lengths:
+        res.append([WordReadout(text, aabb, confidence)
+                    for text, aabb, confidence in (next(words) for _ in range(line_length))])
+    return res
+
+
+class MemoryBackend:
+    """Least recently used entries of this process, up to max_bytes in total."""
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._num_bytes -= len(old)
+            self._entries[key] = value
+            self._num_bytes += len(value)
+            while self._num_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= len(evicted)
+
+    def delete(self, key: str):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._num_bytes -= len(value)
+
+
+def _touch(path: str):
+    # explicit time, file system timestamps set by the kernel may be coarser than the time between accesses
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+class DiskBackend:
+    """Entries stored as files in a directory (shared by processes), least recently used (by mtime) files are
+    deleted when the directory exceeds max_bytes. Eviction scans the whole directory, so it deletes down to
+    low_water * max_bytes, which leaves room for many writes before the next scan."""
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 2 ** 20, low_water: float = 0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._num_bytes = None  # estimate of the directory size, recomputed on eviction
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            _touch(path)  # mark as recently used
+            return value
+        except OSError:
+            return None
+
+    def set(self, key: str, value: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        _touch(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._num_bytes is None:
+                self._num_bytes = sum(size for _, size, _ in self._files())
+            else:
+                self._num_bytes += len(value)
+            if self._num_bytes > self.max_bytes:
+                self._evict()
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _files(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                for file in os.scandir(entry.path):
+                    if not file.name.endswith('.tmp'):
+                        stat = file.stat()
+                        yield file.path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda file: file[2])
+        num_bytes = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if num_bytes <= self.low_water * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            num_bytes -= size
+        self._num_bytes = num_bytes
+
+
+class RedisBackend:
+    """Entries stored in Redis (shared by hosts), least recently used entries are deleted when the entries of this
+    cache exceed max_bytes. Access times and sizes are kept in a sorted set and a hash next to the entries."""
+
+    def __init__(self, client, max_bytes: int = 256 * 2 ** 20, prefix: str = 'htr:page:'):
+        """client is a redis.Redis instance (or any client with the same interface)."""
+        self.client = client
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._lru_key = prefix + 'lru'
+        self._sizes_key = prefix + 'sizes'
+        self._total_key = prefix + 'total'
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'RedisBackend':
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.client.get(self.prefix + key)
+        if value is not None:
+            self.client.zadd(self._lru_key, {key: time.time()})
+        return value
+
+    def delete(self, key: str):
+        size = int(self.client.hget(self._sizes_key, key) or 0)
+        pipe = self.client.pipeline()
+        pipe.delete(self.prefix + key)
+        pipe.zrem(self._lru_key, key)
+        pipe.hdel(self._sizes_key, key)
+        pipe.decrby(self._total_key, size)
+        pipe.execute()
+
+    def set(self, key: str, value: bytes):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, value)
+        pipe.zadd(self._lru_key, {key: time.time()})
+        pipe.hget(self._sizes_key, key)
+        pipe.hset(self._sizes_key, key, len(value))
+        old_size = pipe.execute()[2]
+        total = self.client.incrby(self._total_key, len(value) - int(old_size or 0))
+
+        while total > self.max_bytes:
+            oldest = self.client.zpopmin(self._lru_key)
+            if not oldest:
+                break
+            evicted = oldest[0][0].decode() if isinstance(oldest[0][0], bytes) else oldest[0][0]
+            size = int(self.client.hget(self._sizes_key, evicted) or 0)
+            pipe = self.client.pipeline()
+            pipe.delete(self.prefix + evicted)
+            pipe.hdel(self._sizes_key, evicted)
+            pipe.decrby(self._total_key, size)
+            total = pipe.execute()[2]
+
+
+def _config_repr(config) -> str:
+    """Settings of a config dataclass, the prefix tree is represented by the caller."""
+    return repr([(f.name, getattr(config, f.name)) for f in dataclasses.fields(config) if f.name != 'prefix_tree'])
+
+
+class PageCache:
+    """Read pages (lines of WordReadouts) stored in a backend (MemoryBackend, DiskBackend, RedisBackend)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self,
+            image: Union[bytes, np.ndarray],
+            detector_config: DetectorConfig,
+            line_clustering_config: LineClusteringConfig,
+            reader_config: ReaderConfig) -> str:
+        """Key of the page: hash of the image (encoded file content, or decoded pixels) and the settings."""
+        h = hashlib.sha256()
+        h.update(f'{CACHE_VERSION}\n'.encode())
+        if isinstance(image, np.ndarray):
+            h.update(f'{image.shape} {image.dtype}\n'.encode())
+            h.update(np.ascontiguousarray(image).data)
+        else:
+            h.update(image)
+        for config in (detector_config, line_clustering_config, reader_config):
+            h.update(_config_repr(config).encode())
+        if reader_config.prefix_tree is not None and reader_config.decoder != 'best_path':
+            h.update(reader_config.prefix_tree.fingerprint().encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[List[List[WordReadout]]]:
+        try:
+            data = self.backend.get(key)
+        except Exception as e:  # a failing cache must never fail the pipeline
+            logger.warning('Page cache lookup failed: %s', e)
+            data = None
+        if data is None:
+            self.misses += 1
+            return None
+        try:
+            read_lines = deserialize_lines(data)
+        except Exception as e:  # corrupt or foreign entry, read the page again and replace the entry
+            logger.warning('Page cache entry %s is invalid: %s', key, e)
+            self.misses += 1
+            try:
+                self.backend.delete(key)
+            except Exception:
+                pass
+            return None
+        self.hits += 1
+        return read_lines
+
+    def put(self, key: str, read_lines: List[List[WordReadout]]):
+        try:
+            self.backend.set(key, serialize_lines(read_lines))
+        except Exception as e:
+            logger.warning('Page cache update failed: %s', e)
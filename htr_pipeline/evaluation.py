@@ -0,0 +1,71 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import List, Sequence
+
+import cv2
+import numpy as np
+
+
+@dataclass
+class Sample:
+    """Page image with its ground truth text and the detector settings to use for it."""
+    name: str
+    img: np.ndarray
+    gt_text: str
+    scale: float = 1.0
+    margin: int = 0
+
+
+def load_samples(sample_dir: str) -> List[Sample]:
+    """Load all images (.png/.jpg) of a directory that have a ground truth text file (same name, .txt).
+
+    Detector settings per image are taken from an optional config.json in the directory, which has the same format as
+    data/config.json (file name -> scale and margin).
+    """
+    config = {}
+    config_path = os.path.join(sample_dir, 'config.json')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            config = json.load(f)
+
+    samples = []
+    for name in sorted(os.listdir(sample_dir)):
+        stem, ext = os.path.splitext(name)
+        gt_path = os.path.join(sample_dir, stem + '.txt')
+        if ext.lower() not in ('.png', '.jpg', '.jpeg') or not os.path.exists(gt_path):
+            continue
+        with open(gt_path) as f:
+            gt_text = f.read()
+        img = cv2.imread(os.path.join(sample_dir, name), cv2.IMREAD_GRAYSCALE)
+        sample_config = config.get(name, {})
+        samples.append(Sample(name, img, gt_text, sample_config.get('scale', 1.0), sample_config.get('margin', 0)))
+    return samples
+
+
+def edit_distance(a: Sequence, b: Sequence) -> int:
+    """Levenshtein distance between two sequences (of chars or words)."""
+    prev = list(range(len(b) + 1))
+    for i, x in enumerate(a, start=1):
+        curr = [i]
+        for j, y in enumerate(b, start=1):
+            curr.append(min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (x != y)))
+        prev = curr
+    return prev[-1]
+
+
+def char_error_rate(pred: str, gt: str) -> float:
+    """Edit distance between the texts (whitespace normalized), divided by the length of the ground truth."""
+    pred, gt = ' '.join(pred.split()), ' '.join(gt.split())
+    return edit_distance(pred, gt) / max(len(gt), 1)
+
+
+def word_accuracy(pred: str, gt: str) -> float:
+    """1 - word error rate, clipped to 0."""
+    pred_words, gt_words = pred.split(), gt.split()
+    return max(0.0, 1 - edit_distance(pred_words, gt_words) / max(len(gt_words), 1))
+
+
+def lines_to_text(read_lines) -> str:
+    """Text of a page as returned by read_page: words of a line separated by spaces, lines by newlines."""
+    return '\n'.join(' '.join(word.text for word in line) for line in read_lines)
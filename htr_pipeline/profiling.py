@@ -0,0 +1,144 @@
+"""Opt-in per-stage instrumentation of the pipeline.
+
+Stages of the pipeline (model forward passes, decoding, clustering, ...) are wrapped in stage(). Without an active
+PipelineStats, stage() returns a shared no-op object, so the instrumentation costs only a context variable lookup.
+
+Usage:
+    with profile() as stats:
+        read_page(img)
+    print(stats.report())
+
+Hooks receive every recorded stage, e.g. to forward the timings to a metrics system:
+    stats = PipelineStats(hooks=[lambda stage, seconds, items, shape: statsd.timing(stage, seconds * 1000)])
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# hook(stage, seconds, items, shape) is called for every recorded stage
+Hook = Callable[[str, float, Optional[int], Optional[Tuple[int, ...]]], None]
+
+
+@dataclass
+class StageStats:
+    """Accumulated measurements of one stage."""
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    items: int = 0  # number of processed items (boxes, words, ...), if reported by the stage
+    shapes: Dict[Tuple[int, ...], int] = field(default_factory=dict)  # tensor shape -> number of calls
+
+
+class PipelineStats:
+    """Wall time, call counts, item counts and tensor shapes per stage, collected while active (see profile())."""
+
+    def __init__(self, hooks: Optional[List[Hook]] = None):
+        self.stages: Dict[str, StageStats] = {}
+        self.hooks: List[Hook] = list(hooks or [])
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Hook):
+        self.hooks.append(hook)
+
+    def record(self, stage: str, seconds: float, items: Optional[int] = None, shape: Optional[Tuple[int, ...]] = None):
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if items is not None:
+                stats.items += items
+            if shape is not None:
+                stats.shapes[shape] = stats.shapes.get(shape, 0) + 1
+        for hook in self.hooks:
+            hook(stage, seconds, items, shape)
+
+    def summary(self) -> dict:
+        """Measurements of all stages as JSON serializable dict."""
+        with self._lock:
+            return {name: {'calls': s.calls, 'seconds': s.seconds, 'max_seconds': s.max_seconds, 'items': s.items,
+                           'shapes': {'x'.join(map(str, shape)): n for shape, n in s.shapes.items()}}
+                    for name, s in self.stages.items()}
+
+    def report(self) -> str:
+        """Table of the stages, sorted by total time."""
+        rows = [f'{"stage":<24} {"calls":>6} {"total ms":>10} {"mean ms":>9} {"max ms":>9} {"items":>8}']
+        for name, s in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            rows.append(f'{name:<24} {s["calls"]:>6} {s["seconds"] * 1000:10.2f} '
+                        f'{s["seconds"] * 1000 / s["calls"]:9.3f} {s["max_seconds"] * 1000:9.3f} {s["items"]:>8}')
+        return '\n'.join(rows)
+
+
+_ACTIVE_STATS: ContextVar[Optional[PipelineStats]] = ContextVar('htr_pipeline_stats', default=None)
+
+
+@contextmanager
+def profile(stats: Optional[PipelineStats] = None) -> Iterator[PipelineStats]:
+    """Collect the stage measurements of the pipeline calls inside the with block (of this thread or task)."""
+    stats = stats if stats is not None else PipelineStats()
+    token = _ACTIVE_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        _ACTIVE_STATS.reset(token)
+
+
+def get_active_stats() -> Optional[PipelineStats]:
+    return _ACTIVE_STATS.get()
+
+
+class _Stage:
+    """Measures the wall time of a with block, the block may report its number of items and tensor shape."""
+
+    __slots__ = ('_stats', '_name', '_items', '_shape', '_start')
+
+    def __init__(self, stats: PipelineStats, name: str, items: Optional[int], shape: Optional[Tuple[int, ...]]):
+        self._stats = stats
+        self._name = name
+        self._items = items
+        self._shape = shape
+
+    def set(self, items: Optional[int] = None, shape: Optional[Tuple[int, ...]] = None):
+        if items is not None:
+            self._items = items
+        if shape is not None:
+            self._shape = tuple(shape)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._stats.record(self._name, time.perf_counter() - self._start, self._items, self._shape)
+        return False
+
+
+class _NoStage:
+    """Stand-in for _Stage when no stats are collected."""
+
+    __slots__ = ()
+
+    def set(self, items=None, shape=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name: str, items: Optional[int] = None, shape: Optional[Tuple[int, ...]] = None):
+    """Context manager measuring the stage with the given name, a no-op if no stats are active."""
+    stats = _ACTIVE_STATS.get()
+    if stats is None:
+        return _NO_STAGE
+    return _Stage(stats, name, items, None if shape is None else tuple(shape))
@@ -0,0 +1,151 @@
+"""Create INT8-quantized versions of the detector and reader models and compare them to the FP32 models.
+
+The quantized models are written next to the original ones (models/detector.int8.onnx, models/reader.int8.onnx) and
+are used by setting precision='int8' in DetectorConfig and ReaderConfig.
+
+Usage:
+    python -m htr_pipeline.quantize --mode dynamic
+    python -m htr_pipeline.quantize --mode static --samples path/to/samples --report report.json
+
+The sample directory contains page images with ground truth texts (see htr_pipeline.evaluation.load_samples). It is
+used for calibration (static mode) and for the accuracy/speed report.
+"""
+import argparse
+import json
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+from pkg_resources import resource_filename
+
+from . import DetectorConfig, LineClusteringConfig, ReaderConfig, read_page
+from .evaluation import Sample, char_error_rate, lines_to_text, load_samples, word_accuracy
+from .reader import transform
+from .runtime import model_file
+from .word_detector import detect, pad_image
+
+MODEL_NAMES = ('detector', 'reader')
+
+
+def _calibration_inputs(model_name: str, samples: List[Sample], max_num: int) -> Iterator[Dict[str, np.ndarray]]:
+    """Model inputs computed from the sample pages, in the same way as the pipeline does it."""
+    import cv2
+
+    num = 0
+    for sample in samples:
+        if model_name == 'detector':
+            img = pad_image(cv2.resize(sample.img, None, fx=sample.scale, fy=sample.scale))
+            inputs = [img.astype(np.float32)[None, None] / 255 - 0.5]
+        else:
+            inputs = [transform(det.img)[None, None].astype(np.float32)
+                      for det in detect(sample.img, sample.scale, sample.margin)]
+        for x in inputs:
+            if num == max_num:
+                return
+            num += 1
+            yield {'input': x}
+
+
+def quantize_model(model_name: str, mode: str, samples: List[Sample], max_calibration_inputs: int = 200) -> str:
+    """Quantize a model and write it to models/<model_name>.int8.onnx. Returns the path of the quantized model."""
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, \
+        quantize_static
+
+    src = resource_filename('htr_pipeline', f'models/{model_file(model_name, "fp32")}')
+    dst = resource_filename('htr_pipeline', f'models/{model_file(model_name, "int8")}')
+
+    if mode == 'dynamic':
+        quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    elif mode == 'static':
+        if not samples:
+            raise ValueError('Static quantization needs sample pages for calibration.')
+
+        class _Reader(CalibrationDataReader):
+            def __init__(self):
+                self._inputs = _calibration_inputs(model_name, samples, max_calibration_inputs)
+
+            def get_next(self):
+                return next(self._inputs, None)
+
+        quantize_static(src, dst, _Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        raise ValueError('Unknown mode. Available: "dynamic" and "static".')
+
+    return dst
+
+
+def evaluate_precision(samples: List[Sample], precision: str, repeat: int = 1) -> dict:
+    """Read all sample pages with the models of the given precision, measure throughput and accuracy."""
+    texts = {}
+    read_page(samples[0].img, DetectorConfig(samples[0].scale, samples[0].margin, precision),
+              reader_config=ReaderConfig(precision=precision))  # warm up
+
+    start_time = time.perf_counter()
+    num_words = 0
+    for _ in range(repeat):
+        for sample in samples:
+            read_lines = read_page(sample.img,
+                                   DetectorConfig(sample.scale, sample.margin, precision),
+                                   LineClusteringConfig(min_words_per_line=1),
+                                   ReaderConfig(precision=precision))
+            texts[sample.name] = lines_to_text(read_lines)
+            num_words += sum(len(line) for line in read_lines)
+    duration = time.perf_counter() - start_time
+
+    return {
+        'precision': precision,
+        'pages_per_second': len(samples) * repeat / duration,
+        'words_per_second': num_words / duration,
+        'cer': float(np.mean([char_error_rate(texts[s.name], s.gt_text) for s in samples])),
+        'word_accuracy': float(np.mean([word_accuracy(texts[s.name], s.gt_text) for s in samples])),
+        'texts': texts,
+    }
+
+
+def build_report(samples: List[Sample], repeat: int = 1) -> dict:
+    """Compare the FP32 and INT8 models on the samples."""
+    results = {precision: evaluate_precision(samples, precision, repeat) for precision in ('fp32', 'int8')}
+    fp32, int8 = results['fp32'], results['int8']
+    return {
+        'num_pages': len(samples),
+        'fp32': {k: v for k, v in fp32.items() if k != 'texts'},
+        'int8': {k: v for k, v in int8.items() if k != 'texts'},
+        'speedup': int8['pages_per_second'] / fp32['pages_per_second'],
+        'cer_int8_vs_fp32': float(np.mean([char_error_rate(int8['texts'][s.name], fp32['texts'][s.name])
+                                           for s in samples])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize the detector and reader models to INT8.')
+    parser.add_argument('--mode', choices=['dynamic', 'static'], default='dynamic')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=list(MODEL_NAMES))
+    parser.add_argument('--samples', help='directory with sample pages and ground truth texts')
+    parser.add_argument('--max-calibration-inputs', type=int, default=200)
+    parser.add_argument('--report', help='write the accuracy/speed report (JSON) to this file')
+    parser.add_argument('--repeat', type=int, default=1, help='how often the samples are read for the report')
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples) if args.samples else []
+    for model_name in args.models:
+        print(f'Quantized {model_name}: {quantize_model(model_name, args.mode, samples, args.max_calibration_inputs)}')
+
+    if not samples:
+        print('No samples given, skipping the accuracy/speed report.')
+        return
+
+    report = build_report(samples, args.repeat)
+    report['mode'] = args.mode
+    for precision in ('fp32', 'int8'):
+        r = report[precision]
+        print(f'{precision}: {r["pages_per_second"]:.2f} pages/s, {r["words_per_second"]:.1f} words/s, '
+              f'CER {r["cer"]:.4f}, word accuracy {r["word_accuracy"]:.4f}')
+    print(f'speedup {report["speedup"]:.2f}x, CER of int8 against fp32 output {report["cer_int8_vs_fp32"]:.4f}')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
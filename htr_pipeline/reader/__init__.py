@@ -1,65 +1,406 @@
 import json
 import math
-from typing import Optional
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
-import onnxruntime as ort
 from pkg_resources import resource_filename
 
-from .ctc import ctc_best_path, ctc_single_word_beam_search, PrefixTree
+from .ctc import ctc_best_path, ctc_single_word_beam_search_with_probs, PrefixTree
+from ..profiling import stage
+from ..runtime import get_bound_io, get_session, model_file
 
 
-def _load_model():
-    """Loads model and model metadata."""
-    ort_session = ort.InferenceSession(resource_filename('htr_pipeline', 'models/reader.onnx'),
-                                       providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
+@lru_cache(maxsize=1)
+def _load_chars() -> List[str]:
+    """Loads model metadata."""
     with open(resource_filename('htr_pipeline', 'models/reader.json')) as f:
-        chars = json.load(f)['chars']
-    return ort_session, chars
+        return json.load(f)['chars']
 
 
-def transform(img: np.ndarray) -> np.ndarray:
-    """Bring image into suitable shape for the model."""
-    target_height = 48
+_TARGET_HEIGHT = 48
+
+
+def _target_size(img: np.ndarray):
+    """Compute scaling factor and width of the model input for the given image."""
+    target_height = _TARGET_HEIGHT
     padding = 32
 
-    # compute shape of target image
     fh = target_height / img.shape[0]
     f = min(fh, 2)
-    h = target_height
     w = math.ceil(img.shape[1] * f)
     w = w + (4 - w) % 4
     w += padding
+    return f, w
 
-    # create target image
-    res = 255 * np.ones((h, w), dtype=np.uint8)
 
-    # copy image into target image
+def transform_into(img: np.ndarray, out: np.ndarray):
+    """Bring image into suitable shape for the model, writing the normalized result into the float32 array out.
+
+    The image is centered in out, whose width must be at least the natural target width of the image.
+    """
+    f, _ = _target_size(img)
     img = cv2.resize(img, dsize=None, fx=f, fy=f)
-    th = (res.shape[0] - img.shape[0]) // 2
-    tw = (res.shape[1] - img.shape[1]) // 2
-    res[th:img.shape[0] + th, tw:img.shape[1] + tw] = img
-    res = res
 
-    return res / 255 - 0.5
+    # white background, copy image into its center and normalize it in place
+    out.fill(0.5)
+    th = (out.shape[0] - img.shape[0]) // 2
+    tw = (out.shape[1] - img.shape[1]) // 2
+    region = out[th:img.shape[0] + th, tw:img.shape[1] + tw]
+    np.multiply(img, 1 / 255, out=region, casting='unsafe')
+    region -= 0.5
+
+
+def transform(img: np.ndarray, width: Optional[int] = None) -> np.ndarray:
+    """Bring image into suitable shape for the model.
+
+    If width is given (and at least as large as the natural target width), the image is centered in a canvas of
+    that width, which allows stacking images of similar size into one batch.
+    """
+    _, w = _target_size(img)
+    if width is not None:
+        w = max(w, width)
+
+    res = np.empty((_TARGET_HEIGHT, w), np.float32)
+    transform_into(img, res)
+    return res
+
+
+def _get_model(precision: str = 'fp32'):
+    """Returns model and model metadata, both are loaded on first use."""
+    return get_session(model_file('reader', precision)), _load_chars()
+
+
+def warmup(precision: str = 'fp32'):
+    """Load the model and run it once, so that the first call to read() is not slowed down by initialization."""
+    ort_session, _ = _get_model(precision)
+    ort_session.run(None, {'input': np.zeros((1, 1, 48, 64), np.float32)})
+
+
+# words whose best path confidence is at least this high are accepted by the 'auto' decoder without beam search, see
+# benchmarks.auto_decoder: clean words score above, words with a char split between two candidates below this value
+DEFAULT_CONFIDENCE_THRESHOLD = 0.65
+
+
+def _confidences(predictions: np.ndarray) -> np.ndarray:
+    """Confidence of the best path of each batch element (WxBxC model output): the smallest probability of its
+    time-steps, i.e. of its least certain char or blank. Unlike the path probability, it does not shrink with the
+    length of the word."""
+    return predictions.max(axis=2).min(axis=0).astype(np.float64)
+
 
+# the 'auto' decoder replaces the best path by the beam search result only if the beam is at least this fraction as
+# probable as the best path
+_MIN_BEAM_PROB_RATIO = 0.01
 
-# global vars holding the model and model metadata
-_ORT_SESSION, _CHARS = _load_model()
 
+def _dictionary_case(prefix_tree: PrefixTree) -> Optional[str]:
+    """'upper' or 'lower' if the letters of all dictionary words are in this case, None otherwise."""
+    letters = ''.join(prefix_tree.chars())
+    if letters.isupper():
+        return 'upper'
+    if letters.islower():
+        return 'lower'
+    return None
 
-def read(img: np.ndarray, decoder: str, prefix_tree: Optional[PrefixTree] = None) -> str:
+
+@lru_cache(maxsize=8)
+def _case_fold_labels(chars: Tuple[str, ...], case: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Labels of the chars of the other case, and the labels of the same chars in the given case."""
+    label = {c: i for i, c in enumerate(chars, start=1)}
+    folded = {c: c.upper() if case == 'upper' else c.lower() for c in chars}
+    pairs = [(label[c], label[f]) for c, f in folded.items() if f != c and f in label]
+    return np.array([src for src, _ in pairs], np.int64), np.array([dst for _, dst in pairs], np.int64)
+
+
+def _fold_case(predictions: np.ndarray, chars: List[str], case: str) -> np.ndarray:
+    """Model output with the probability of each letter moved to the same letter in the given case."""
+    src, dst = _case_fold_labels(tuple(chars), case)
+    folded = predictions.copy()
+    folded[..., dst] += predictions[..., src]
+    folded[..., src] = 0
+    return folded
+
+
+def _restore_case(word: str, template: str) -> str:
+    """Dictionary word in the case of the text it replaces: all upper case, capitalized, or lower case."""
+    if len(template) > 1 and template.isupper():
+        return word.upper()
+    if template[:1].isupper():
+        return word[:1].upper() + word[1:].lower()
+    return word.lower()
+
+
+def _beam_search(predictions: np.ndarray,
+                 chars: List[str],
+                 prefix_tree: PrefixTree,
+                 templates: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Word beam search (see ctc_single_word_beam_search_with_probs). Dictionaries in a single case (e.g. the upper
+    case lexicon of the app) are matched case-insensitively, the found words get the case of the template texts."""
+    case = _dictionary_case(prefix_tree)
+    if case is None:
+        return ctc_single_word_beam_search_with_probs(predictions, chars, 25, prefix_tree)
+    texts, probs = ctc_single_word_beam_search_with_probs(_fold_case(predictions, chars, case), chars, 25, prefix_tree)
+    return [_restore_case(text, template) for text, template in zip(texts, templates)], probs
+
+
+def _decode(predictions: np.ndarray,
+            decoder: str,
+            prefix_tree: Optional[PrefixTree],
+            chars: List[str],
+            confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD) -> Tuple[List[str], np.ndarray]:
+    """Decode the model output of shape WxBxC into one text and its confidence (see _confidences) per batch element."""
+    with stage('read.ctc_decode', items=predictions.shape[1]):
+        confidences = _confidences(predictions)
+        if decoder == 'best_path':
+            return ctc_best_path(predictions, chars), confidences
+        elif decoder == 'word_beam_search':
+            return _beam_search(predictions, chars, prefix_tree, ctc_best_path(predictions, chars))[0], confidences
+        elif decoder == 'auto':
+            texts = ctc_best_path(predictions, chars)
+            if prefix_tree is None:
+                return texts, confidences
+
+            # dictionaries in a single case are matched case-insensitively, see _beam_search
+            fold = {'upper': str.upper, 'lower': str.lower}.get(_dictionary_case(prefix_tree), str)
+
+            # beam search only for the words that are neither confident nor in the dictionary, words with digits
+            # unknown to the dictionary (e.g. question numbers) are kept as read
+            digits = {c for c in chars if c.isdigit()} - prefix_tree.chars()
+            unsure = [b for b, (text, confidence) in enumerate(zip(texts, confidences))
+                      if confidence < confidence_threshold and digits.isdisjoint(text)
+                      and not prefix_tree.is_word(fold(text))]
+            if unsure:
+                with stage('read.ctc_beam_search', items=len(unsure)):
+                    beam_texts, beam_probs = _beam_search(predictions[:, unsure], chars, prefix_tree,
+                                                          [texts[b] for b in unsure])
+
+                # keep the best path if no dictionary word was found, or the word is far less probable
+                log_path_probs = np.log(predictions[:, unsure].max(axis=2).astype(np.float64)).sum(axis=0)
+                with np.errstate(divide='ignore'):
+                    log_beam_probs = np.log(beam_probs)
+                for b, text, log_beam_prob, log_path_prob in zip(unsure, beam_texts, log_beam_probs, log_path_probs):
+                    if text and log_beam_prob >= log_path_prob + math.log(_MIN_BEAM_PROB_RATIO):
+                        texts[b] = text
+            return texts, confidences
+    raise Exception('Unknown decoder. Available: "best_path", "word_beam_search" and "auto".')
+
+
+def read(img: np.ndarray,
+         decoder: str,
+         prefix_tree: Optional[PrefixTree] = None,
+         precision: str = 'fp32',
+         confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD) -> str:
     """Recognizes text in image."""
     img = transform(img)
-    img = img[None, None].astype(np.float32)
-    outputs = _ORT_SESSION.run(None, {'input': img})
+    img = img[None, None]
+    ort_session, chars = _get_model(precision)
+    with stage('read.forward', shape=img.shape):
+        outputs = ort_session.run(None, {'input': img})
+    return _decode(outputs[0], decoder, prefix_tree, chars, confidence_threshold)[0][0]
+
+
+def read_batch(imgs: Sequence[np.ndarray],
+               decoder: str,
+               prefix_tree: Optional[PrefixTree] = None,
+               batch_size: int = 64,
+               bucket_width: int = 32,
+               precision: str = 'fp32',
+               confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD) -> List[str]:
+    """Recognizes text in a list of images, see read_batch_with_confidences."""
+    return read_batch_with_confidences(imgs, decoder, prefix_tree, batch_size, bucket_width, precision,
+                                       confidence_threshold)[0]
+
+
+def read_batch_with_confidences(imgs: Sequence[np.ndarray],
+                                decoder: str,
+                                prefix_tree: Optional[PrefixTree] = None,
+                                batch_size: int = 64,
+                                bucket_width: int = 32,
+                                precision: str = 'fp32',
+                                confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD
+                                ) -> Tuple[List[str], List[float]]:
+    """Recognizes text in a list of images, running the model on batches of images instead of one by one.
+
+    Images are grouped into buckets by their target width (rounded up to a multiple of bucket_width), so that
+    only little padding is needed to stack the images of a bucket into one input tensor.
+
+    Args:
+        imgs: List of word images.
+        decoder: 'best_path', 'word_beam_search', or 'auto' (best path, word beam search only for words that are
+            neither confident nor in the dictionary).
+        prefix_tree: Prefix tree containing the dictionary words, needed for word beam search and used by 'auto'.
+        batch_size: Maximum number of images processed in one inference call.
+        bucket_width: Granularity of the width buckets.
+        precision: 'fp32' or 'int8' (quantized model).
+        confidence_threshold: Confidence from which the 'auto' decoder accepts the best path.
+
+    Returns:
+        List of texts and list of their confidences (smallest probability of the time-steps of the best path), one
+        for each image, in the same order as the images.
+    """
+    _, chars = _get_model(precision)
+    res = [''] * len(imgs)
+    confidences = [0.0] * len(imgs)
+    widths = [_target_size(img)[1] for img in imgs]
+    for batch_idxs, predictions, _ in _run_batches(widths, lambda i, out: transform_into(imgs[i], out), batch_size,
+                                                   bucket_width, precision):
+        texts, probs = _decode(predictions, decoder, prefix_tree, chars, confidence_threshold)
+        for i, text, prob in zip(batch_idxs, texts, probs):
+            res[i] = text
+            confidences[i] = float(prob)
+
+    return res, confidences
+
+
+def _run_batches(widths: Sequence[int],
+                 fill: Callable[[int, np.ndarray], None],
+                 batch_size: int,
+                 bucket_width: int,
+                 precision: str) -> Iterator[Tuple[List[int], np.ndarray, int]]:
+    """Run the model on batches of inputs, which are grouped into buckets by their width.
+
+    Args:
+        widths: Natural width of each input.
+        fill: fill(i, out) writes input i into out, a float32 array of the model height and the bucket width.
+        batch_size: Maximum number of inputs processed in one inference call.
+        bucket_width: Granularity of the width buckets.
+        precision: 'fp32' or 'int8' (quantized model).
+
+    Yields:
+        Indices of the inputs of a batch, the model output of shape WxBxC (only valid until the next batch is run)
+        and the input width of the batch.
+    """
+    buckets = defaultdict(list)
+    for i, w in enumerate(widths):
+        buckets[math.ceil(w / bucket_width) * bucket_width].append(i)
+
+    for width, idxs in sorted(buckets.items()):
+        for start in range(0, len(idxs), batch_size):
+            batch_idxs = idxs[start:start + batch_size]
+
+            # reuse the buffers of this width, sized for the largest batch of the bucket, the model only runs on the
+            # rows of the batch
+            bound_io = get_bound_io(model_file('reader', precision),
+                                    (min(batch_size, len(idxs)), 1, _TARGET_HEIGHT, width))
+            with stage('read.transform', items=len(batch_idxs)):
+                for row, i in enumerate(batch_idxs):
+                    fill(i, bound_io.input[row, 0])
+
+            with stage('read.forward', shape=(len(batch_idxs),) + bound_io.input.shape[1:]):
+                predictions = bound_io.run(len(batch_idxs))
+            yield batch_idxs, predictions, width
+
+
+_LINE_PADDING = 16  # white space left of the first and right of the last word of a line strip
+_WORD_GAP = 32  # white space between the words of a line strip, wide enough that the model reads blanks in between
+
+
+def _line_layout(imgs: Sequence[np.ndarray]) -> Tuple[List[Tuple[int, int]], List[int], int]:
+    """Size (width, height) of each word image scaled to the model height, its x offset in the line strip, and the
+    natural width of the strip."""
+    sizes = []
+    for img in imgs:
+        f = min(_TARGET_HEIGHT / img.shape[0], 2)
+        sizes.append((max(1, round(img.shape[1] * f)), max(1, round(img.shape[0] * f))))
+    offsets = np.cumsum([_LINE_PADDING] + [w + _WORD_GAP for w, _ in sizes[:-1]]).tolist()
+    width = offsets[-1] + sizes[-1][0] + _LINE_PADDING
+    return sizes, offsets, width + (4 - width) % 4
+
+
+def transform_line_into(imgs: Sequence[np.ndarray], out: np.ndarray):
+    """Stitch the word images of a line into one strip for the model, written normalized into the float32 array out.
+
+    The words are scaled like single words (see transform_into), vertically centered and separated by white gaps. The
+    strip starts at the left of out, whose width must be at least the natural width of the strip.
+    """
+    sizes, offsets, _ = _line_layout(imgs)
+    out.fill(0.5)
+    for img, (w, h), x in zip(imgs, sizes, offsets):
+        img = cv2.resize(img, dsize=(w, h))
+        y = (out.shape[0] - h) // 2
+        region = out[y:y + h, x:x + w]
+        np.multiply(img, 1 / 255, out=region, casting='unsafe')
+        region -= 0.5
+
+
+def _split_line(predictions: np.ndarray,
+                width: int,
+                sizes: List[Tuple[int, int]],
+                offsets: List[int],
+                separators: np.ndarray) -> List[np.ndarray]:
+    """Split the model output (WxC) of a line strip of the given input width into the time-steps of each word.
+
+    Each cut is placed at the time-step within the gap between two words that is read as a separator (blank or space
+    label) and is nearest to the middle of the gap, so that chars read across the gap are neither cut off nor doubled.
+    If the whole gap is read as chars, the cut is placed in the middle of the gap.
+    """
+    num_steps = len(predictions)
+    is_separator = np.isin(predictions.argmax(axis=1), separators)
+    cuts = [0]
+    for (w, _), x in zip(sizes[:-1], offsets[:-1]):
+        # time-steps lying completely inside the gap
+        start = math.ceil((x + w) * num_steps / width)
+        end = (x + w + _WORD_GAP) * num_steps // width
+        middle = round((x + w + _WORD_GAP / 2) * num_steps / width)
+        candidates = start + np.flatnonzero(is_separator[start:end])
+        cuts.append(int(candidates[np.argmin(np.abs(candidates - middle))]) if len(candidates) else middle)
+    cuts.append(num_steps)
+    return [predictions[cuts[k]:cuts[k + 1]] for k in range(len(sizes))]
+
+
+def read_line_batch(lines: Sequence[Sequence[np.ndarray]],
+                    decoder: str,
+                    prefix_tree: Optional[PrefixTree] = None,
+                    batch_size: int = 64,
+                    bucket_width: int = 256,
+                    precision: str = 'fp32',
+                    confidence_threshold: float = DEFAULT_CONFIDENCE_THRESHOLD
+                    ) -> Tuple[List[List[str]], List[List[float]]]:
+    """Recognizes the words of text lines, running the model once per line instead of once per word.
+
+    The word images of a line are stitched into one strip (see transform_line_into), and the strips are read in
+    batches grouped by width like read_batch_with_confidences does with words. The model output of a strip is split
+    into the time-steps of each word, which are decoded like the output of a single word image, so each text belongs to
+    the word image (and box) it was read from.
+
+    Args:
+        lines: List of lines, each a non-empty list of word images in reading order.
+        decoder: 'best_path', 'word_beam_search' or 'auto', see read_batch_with_confidences.
+        prefix_tree: Prefix tree containing the dictionary words, needed for word beam search and used by 'auto'.
+        batch_size: Maximum number of lines processed in one inference call.
+        bucket_width: Granularity of the width buckets, lines vary more in width than words.
+        precision: 'fp32' or 'int8' (quantized model).
+        confidence_threshold: Confidence from which the 'auto' decoder accepts the best path.
+
+    Returns:
+        Texts and confidences of the words, as one list per line, in the same order as the images.
+    """
+    _, chars = _get_model(precision)
+    separators = np.array([0] + [label for label, c in enumerate(chars, start=1) if c == ' '])
+    layouts = [_line_layout(imgs) for imgs in lines]
+    res = [[''] * len(imgs) for imgs in lines]
+    confidences = [[0.0] * len(imgs) for imgs in lines]
+    for batch_idxs, predictions, width in _run_batches([layout[2] for layout in layouts],
+                                                       lambda i, out: transform_line_into(lines[i], out), batch_size,
+                                                       bucket_width, precision):
+        segments = [segment for row, i in enumerate(batch_idxs)
+                    for segment in _split_line(predictions[:, row], width, *layouts[i][:2], separators)]
+
+        # decode the words of all lines as one batch, shorter words are padded with blanks (probability 1)
+        word_predictions = np.zeros((max(len(segment) for segment in segments), len(segments), predictions.shape[2]),
+                                    np.float32)
+        word_predictions[..., 0] = 1
+        for k, segment in enumerate(segments):
+            word_predictions[:len(segment), k] = segment
+        readouts = iter(zip(*_decode(word_predictions, decoder, prefix_tree, chars, confidence_threshold)))
 
-    if decoder == 'best_path':
-        text = ctc_best_path(outputs[0], _CHARS)[0]
-    elif decoder == 'word_beam_search':
-        text = ctc_single_word_beam_search(outputs[0], _CHARS, 25, prefix_tree)[0]
-    else:
-        raise Exception('Unknown decoder. Available: "best_path" and "word_beam_search".')
+        for i in batch_idxs:
+            for k in range(len(lines[i])):
+                text, prob = next(readouts)
+                res[i][k] = text.strip(' ')  # spaces read in the gaps between the words
+                confidences[i][k] = float(prob)
 
-    return text
+    return res, confidences
@@ -1,139 +1,340 @@
-from dataclasses import dataclass, field
-from itertools import groupby
-from typing import List
+import hashlib
+import os
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 
 
-@dataclass
-class PrefixTreeNode:
-    children: dict = field(default_factory=dict)
-    is_word: bool = False
+class TrieArrays(NamedTuple):
+    """Flat representation of a prefix tree, nodes are identified by integer handles (root is 0).
+
+    Nodes are numbered in breadth-first order with the children of each node sorted by char, so the children of
+    node n are the nodes first_child[n]+1..first_child[n+1]. Chars are stored as unicode code points.
+    """
+    first_child: np.ndarray
+    node_parent: np.ndarray
+    node_char: np.ndarray
+    node_is_word: np.ndarray
 
 
 class PrefixTree:
-    def __init__(self, words: List[str]):
-        self.root = PrefixTreeNode()
-        self._add_words(words)
-
-    def _add_word(self, text: str):
-        node = self.root
-        for i in range(len(text)):
-            c = text[i]  # current char
-            if c not in node.children:
-                node.children[c] = PrefixTreeNode()
-            node = node.children[c]
-            is_last = (i + 1 == len(text))
-            if is_last:
-                node.is_word = True
-
-    def _add_words(self, words: List[str]):
-        for w in words:
-            self._add_word(w)
-
-    def _get_node(self, text: str):
-        "get node representing given text"
-        node = self.root
+    """Prefix tree holding the dictionary words, stored in a few flat arrays.
+
+    The tree can be saved to a binary file and loaded via mmap, so that multiple processes share one read-only copy
+    through the page cache.
+    """
+    MAGIC = b'HTRTRIE1'
+    ROOT = 0
+
+    def __init__(self, words: List[str], arrays: Optional[TrieArrays] = None):
+        self._arrays = arrays if arrays is not None else self._build_arrays(words)
+        self._label_tables: Dict[Tuple[str, ...], np.ndarray] = {}
+        self._fingerprint: Optional[str] = None
+        self._chars: Optional[FrozenSet[str]] = None
+
+    @staticmethod
+    def _build_arrays(words: List[str]) -> TrieArrays:
+        words = sorted(set(w for w in words if w))
+        if not words:
+            return TrieArrays(first_child=np.zeros(2, np.int32), node_parent=np.full(1, -1, np.int32),
+                              node_char=np.full(1, -1, np.int32), node_is_word=np.zeros(1, bool))
+
+        # code points of all words as matrix (padded with 0), length of common prefix with the preceding word
+        max_len = max(len(w) for w in words)
+        codes = np.array(words, dtype=f'<U{max_len}').view(np.uint32).reshape(len(words), max_len).astype(np.int32)
+        lens = (codes != 0).sum(axis=1)
+        mismatch = codes[1:] != codes[:-1]
+        lcp = np.concatenate([[0], np.where(mismatch.any(axis=1), mismatch.argmax(axis=1), max_len)])
+
+        # word i creates a new node for each of its prefixes that is longer than the common prefix with word i-1,
+        # nodes are created depth by depth, which gives breadth-first order with sorted children
+        num_nodes = 1 + int((lens - lcp).sum())
+        node_parent = np.full(num_nodes, -1, np.int32)
+        node_char = np.full(num_nodes, -1, np.int32)
+        node_is_word = np.zeros(num_nodes, bool)
+        row_idx = np.arange(len(words))
+        prefix_node = np.zeros(len(words), np.int32)  # node of the prefix of length depth-1 of each word
+        next_node = 1
+        for depth in range(1, max_len + 1):
+            active = lens >= depth
+            new = active & (lcp < depth)
+            new_nodes = np.arange(next_node, next_node + new.sum(), dtype=np.int32)
+            node_parent[new_nodes] = prefix_node[new]
+            node_char[new_nodes] = codes[new, depth - 1]
+            node_is_word[new_nodes] = lens[new] == depth
+
+            # words sharing the prefix of the current length with their predecessor share its node
+            row_node = np.zeros(len(words), np.int32)
+            row_node[new] = new_nodes
+            prefix_node = row_node[np.maximum.accumulate(np.where(new, row_idx, 0))]
+            next_node += len(new_nodes)
+
+        first_child = np.searchsorted(node_parent[1:], np.arange(num_nodes + 1)).astype(np.int32)
+        return TrieArrays(first_child=first_child, node_parent=node_parent, node_char=node_char,
+                          node_is_word=node_is_word)
+
+    def save(self, path: str):
+        """Save tree to a binary file, the file is written atomically."""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(np.uint64(len(self._arrays.node_parent)).tobytes())
+            for arr in self._arrays:
+                f.write(np.ascontiguousarray(arr).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PrefixTree':
+        """Load tree from a binary file written by save(), the arrays are memory-mapped (read-only)."""
+        with open(path, 'rb') as f:
+            header = f.read(16)
+        if header[:8] != cls.MAGIC:
+            raise ValueError(f'Not a prefix tree file: {path}')
+        num_nodes = int(np.frombuffer(header[8:], np.uint64)[0])
+
+        offset = 16
+        arrays = []
+        for dtype, num in [(np.int32, num_nodes + 1), (np.int32, num_nodes), (np.int32, num_nodes),
+                           (bool, num_nodes)]:
+            arrays.append(np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num,)))
+            offset += num * np.dtype(dtype).itemsize
+        return cls([], TrieArrays(*arrays))
+
+    def fingerprint(self) -> str:
+        """Hash (hex) of the tree content, equal for equal word lists, computed on first use."""
+        if self._fingerprint is None:
+            h = hashlib.sha256()
+            for arr in self._arrays:
+                h.update(np.ascontiguousarray(arr).data)
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def chars(self) -> FrozenSet[str]:
+        """Chars occurring in the dictionary words, computed on first use."""
+        if self._chars is None:
+            self._chars = frozenset(chr(c) for c in np.unique(self._arrays.node_char[1:]))
+        return self._chars
+
+    def as_arrays(self) -> TrieArrays:
+        """Flat array representation of the tree."""
+        return self._arrays
+
+    def children(self, node: int) -> range:
+        """Handles of the child nodes."""
+        return range(self._arrays.first_child[node] + 1, self._arrays.first_child[node + 1] + 1)
+
+    def child(self, node: int, c: str) -> Optional[int]:
+        """Handle of the child node reached by appending char c, None if there is no such node."""
+        begin, end = self._arrays.first_child[node] + 1, self._arrays.first_child[node + 1] + 1
+        code = ord(c)
+        idx = begin + int(np.searchsorted(self._arrays.node_char[begin:end], code))
+        if idx < end and self._arrays.node_char[idx] == code:
+            return idx
+        return None
+
+    def find(self, text: str) -> Optional[int]:
+        """Handle of the node representing the given text, None if text is not a prefix of any word."""
+        node = self.ROOT
         for c in text:
-            if c in node.children:
-                node = node.children[c]
-            else:
+            node = self.child(node, c)
+            if node is None:
                 return None
         return node
 
+    def node_is_word(self, node: int) -> bool:
+        return bool(self._arrays.node_is_word[node])
+
+    def node_next_chars(self, node: int) -> List[str]:
+        return [chr(c) for c in self._arrays.node_char[self._arrays.first_child[node] + 1:
+                                                        self._arrays.first_child[node + 1] + 1]]
+
+    def node_text(self, node: int) -> str:
+        """Text represented by the node with the given handle."""
+        chars = []
+        while node > 0:
+            chars.append(chr(self._arrays.node_char[node]))
+            node = self._arrays.node_parent[node]
+        return ''.join(reversed(chars))
+
     def is_word(self, text: str) -> bool:
-        node = self._get_node(text)
-        if node:
-            return node.is_word
+        node = self.find(text)
+        if node is not None:
+            return self.node_is_word(node)
         return False
 
     def get_next_chars(self, text: str) -> List[str]:
-        chars = []
-        node = self._get_node(text)
-        if node:
-            for k in node.children.keys():
-                chars.append(k)
-        return chars
+        node = self.find(text)
+        if node is not None:
+            return self.node_next_chars(node)
+        return []
+
 
+def _label_tables(prefix_tree: PrefixTree, chars: List[str]) -> np.ndarray:
+    """Labels of all nodes of the prefix tree (-1 for the root and for chars unknown to the model)."""
+    key = tuple(chars)
+    if key not in prefix_tree._label_tables:
+        arrays = prefix_tree.as_arrays()
+        max_code = max(int(arrays.node_char.max(initial=0)), max((ord(c) for c in chars), default=0))
+        char_to_label = np.full(max_code + 2, -1, np.int32)  # last entry is hit by the root (char -1)
+        for label, c in enumerate(chars, start=1):
+            char_to_label[ord(c)] = label
+        prefix_tree._label_tables[key] = char_to_label[arrays.node_char]
+    return prefix_tree._label_tables[key]
 
-@dataclass
-class Beam:
-    text: str
-    prob_blank: float
-    prod_non_blank: float
 
-    @property
-    def prob_total(self) -> float:
-        return self.prob_blank + self.prod_non_blank
+def _group_matrix(values: np.ndarray, groups: np.ndarray, num_groups: int, fill: float):
+    """Scatter values, which are sorted by group, into a matrix with one row per group.
+
+    Returns the matrix, the start index of each group and the number of elements in each group.
+    """
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    mat = np.full((num_groups, max(counts.max(initial=0), 1)), fill)
+    mat[groups, np.arange(len(groups)) - starts[groups]] = values
+    return mat, starts, counts
 
 
 def ctc_single_word_beam_search(predictions: np.ndarray,
                                 chars: List[str],
                                 beam_width: int,
-                                prefix_tree: PrefixTree):
-    res = []
-    for batch_idx in range(predictions.shape[1]):
-        num_timesteps = predictions.shape[0]
-        prev = [Beam('', 1, 0)]
-
-        # go over all time-steps
-        for time_idx in range(num_timesteps):
-            curr = []  # list of beams at current time-step
-
-            # go over best beams
-            best_beams = sorted(prev, key=lambda x: x.prob_total, reverse=True)[:beam_width]  # get best beams
-            for beam in best_beams:
-                # calc probability that beam ends with non-blank
-                pr_non_blank = 0
-                if beam.text != '':
-                    # char at time-step t must also occur at t-1
-                    label_idx = chars.index(beam.text[-1]) + 1
-                    pr_non_blank = beam.prod_non_blank * predictions[time_idx, batch_idx, label_idx]
-
-                # calc probability that beam ends with blank
-                pr_blank = beam.prob_total * predictions[time_idx, batch_idx, 0]
-
-                # save result
-                curr.append(Beam(beam.text, pr_blank, pr_non_blank))
-
-                # extend current beam with characters according to language model
-                # nextChars = beam.getNextChars()
-                next_chars = prefix_tree.get_next_chars(beam.text)
-                for c in next_chars:
-                    # extend current beam with new character
-                    label_idx = chars.index(c) + 1
-                    if beam.text != '' and beam.text[-1] == c:
-                        # same chars must be separated by blank
-                        pr_non_blank = predictions[time_idx, batch_idx, label_idx] * beam.prob_blank
-                    else:
-                        # different chars can be neighbours
-                        pr_non_blank = predictions[time_idx, batch_idx, label_idx] * beam.prob_total
-
-                        # save result
-                    curr.append(Beam(beam.text + c, 0, pr_non_blank))
-
-            # move current beams to next time-step
-            prev = curr
-
-        # return most probable beam
-        prev = [beam for beam in prev if prefix_tree.is_word(beam.text)]  # only keep words
-        best_beams = sorted(prev, key=lambda x: x.prob_total, reverse=True)
-        res.append(best_beams[0].text if best_beams else '')
-
-    return res
+                                prefix_tree: PrefixTree) -> List[str]:
+    """Decode a single dictionary word per batch element, see ctc_single_word_beam_search_with_probs."""
+    return ctc_single_word_beam_search_with_probs(predictions, chars, beam_width, prefix_tree)[0]
+
+
+def ctc_single_word_beam_search_with_probs(predictions: np.ndarray,
+                                           chars: List[str],
+                                           beam_width: int,
+                                           prefix_tree: PrefixTree) -> Tuple[List[str], np.ndarray]:
+    """Decode a single dictionary word per batch element, beams are constrained by the prefix tree.
+
+    All batch elements are decoded at once. Beams are stored as arrays holding the batch index, the handle of the
+    prefix tree node representing the beam text, and the log-probabilities of ending with a blank/non-blank.
+    Beams are not merged, i.e. the same text can be represented by multiple beams.
+
+    Args:
+        predictions: Output of the model with shape WxBxC, label 0 is the blank.
+        chars: Characters corresponding to the labels 1..C-1.
+        beam_width: Number of beams kept per batch element and time-step.
+        prefix_tree: Prefix tree containing the dictionary words.
+
+    Returns:
+        List of texts, empty text if no dictionary word was found, and array with the probability of the beam of
+        each text (0 if no dictionary word was found).
+    """
+    num_timesteps, batch_size, _ = predictions.shape
+    arrays = prefix_tree.as_arrays()
+    node_label = _label_tables(prefix_tree, chars)
+    with np.errstate(divide='ignore'):
+        log_preds = np.log(predictions)
+
+    # start with empty beam (root node) for each batch element
+    batch_idx = np.arange(batch_size)
+    node = np.zeros(batch_size, np.int32)
+    log_pr_blank = np.zeros(batch_size)
+    log_pr_non_blank = np.full(batch_size, -np.inf)
+
+    # go over all time-steps
+    for time_idx in range(num_timesteps):
+        # get best beams for each batch element, sorted by probability (ties keep the order of the beams)
+        log_pr_total = np.logaddexp(log_pr_blank, log_pr_non_blank)
+        mat, starts, counts = _group_matrix(log_pr_total, batch_idx, batch_size, -np.inf)
+        if mat.shape[1] > beam_width:
+            cols = np.sort(np.argpartition(-mat, beam_width - 1, axis=1)[:, :beam_width], axis=1)
+        else:
+            cols = np.broadcast_to(np.arange(mat.shape[1]), mat.shape)
+        order = np.argsort(-np.take_along_axis(mat, cols, axis=1), axis=1, kind='stable')
+        cols = np.take_along_axis(cols, order, axis=1)
+        best = (starts[:, None] + cols)[cols < counts[:, None]]
+
+        batch_idx, node = batch_idx[best], node[best]
+        log_pr_blank, log_pr_non_blank, log_pr_total = log_pr_blank[best], log_pr_non_blank[best], log_pr_total[best]
+        last_label = node_label[node]
+        log_preds_t = log_preds[time_idx, batch_idx]
+
+        # each beam is kept (extended by blank or its last char), followed by its extensions by the next chars
+        num_children = arrays.first_child[node + 1] - arrays.first_child[node]
+        beam = np.repeat(np.arange(len(node)), num_children + 1)
+        offset = np.arange(len(beam)) - np.repeat(np.cumsum(num_children + 1) - num_children - 1, num_children + 1)
+        is_copy = offset == 0
+        child = (arrays.first_child[node][beam] + offset)[~is_copy]
+        label = np.full(len(beam), -1, np.int32)
+        label[~is_copy] = node_label[child]
+        valid = is_copy | (label >= 0)  # chars unknown to the model can not be appended
+
+        # calc probability that kept beam ends with non-blank (char at time-step t must also occur at t-1),
+        # and that it ends with blank
+        copy_non_blank = np.where(last_label >= 0, log_pr_non_blank + log_preds_t[np.arange(len(node)), last_label],
+                                  -np.inf)
+        copy_blank = log_pr_total + log_preds_t[:, 0]
+
+        # extend beams with new chars, same chars must be separated by blank, different chars can be neighbours
+        ext_beam = beam[~is_copy]
+        ext_label = label[~is_copy]
+        ext_prev = np.where(last_label[ext_beam] == ext_label, log_pr_blank[ext_beam], log_pr_total[ext_beam])
+        ext_non_blank = log_preds_t[ext_beam, ext_label] + ext_prev
+
+        # move current beams to next time-step
+        new_node = node[beam]
+        new_node[~is_copy] = child
+        log_pr_blank = np.full(len(beam), -np.inf)
+        log_pr_blank[is_copy] = copy_blank
+        log_pr_non_blank = np.empty(len(beam))
+        log_pr_non_blank[is_copy] = copy_non_blank
+        log_pr_non_blank[~is_copy] = ext_non_blank
+        batch_idx, node = batch_idx[beam][valid], new_node[valid]
+        log_pr_blank, log_pr_non_blank = log_pr_blank[valid], log_pr_non_blank[valid]
+
+    # return most probable beam that is a word
+    is_word = arrays.node_is_word[node]
+    batch_idx, node = batch_idx[is_word], node[is_word]
+    log_pr_total = np.logaddexp(log_pr_blank[is_word], log_pr_non_blank[is_word])
+    mat, starts, counts = _group_matrix(log_pr_total, batch_idx, batch_size, -np.inf)
+    best = starts + np.argmax(mat, axis=1)
+    texts = [prefix_tree.node_text(node[best[b]]) if counts[b] else '' for b in range(batch_size)]
+    probs = np.exp(mat.max(axis=1))  # rows without words are filled with -inf
+    return texts, probs
 
 
 def ctc_best_path(predictions: np.ndarray, chars: List[str]) -> List[str]:
     # shape of predictions: WxBxC
-    res = []
-    for b in range(predictions.shape[1]):
-        # get char indices along best path
-        best_path = np.argmax(predictions[:, b], axis=1)
+    return ctc_best_path_with_probs(predictions, chars)[0]
+
+
+def ctc_best_path_with_probs(predictions: np.ndarray, chars: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Best path decoding of a whole batch at once.
+
+    Args:
+        predictions: Output of the model with shape WxBxC, label 0 is the blank.
+        chars: Characters corresponding to the labels 1..C-1.
+
+    Returns:
+        List of texts and array with the probability of the best path for each batch element.
+    """
+    # get char indices along best path in batch-major layout (BxW), and the probability of the best path
+    best_path = np.argmax(predictions, axis=2).T
+    probs = predictions.max(axis=2).prod(axis=0)
+    if len(best_path) == 0:
+        return [], probs  # np.split below would give one empty text for an empty batch
+
+    # collapse best path: keep labels that differ from their predecessor and are not blank
+    keep = best_path != 0
+    keep[:, 1:] &= best_path[:, 1:] != best_path[:, :-1]
+
+    # map to chars and split into one text per batch element
+    decoded = _char_table(chars)[best_path[keep] - 1]
+    splits = np.cumsum(keep.sum(axis=1))[:-1]
+    res = [''.join(t) for t in np.split(decoded, splits)]
+
+    return res, probs
+
 
-        # collapse best path (using itertools.groupby), map to chars, join char list to string
-        best_path_decoded = [chars[c - 1] for c, _ in groupby(best_path) if c != 0]
+@lru_cache(maxsize=8)
+def _char_table_cached(chars: Tuple[str, ...]) -> np.ndarray:
+    return np.array(chars, dtype=object)
 
-        text = ''.join(best_path_decoded)
-        res.append(text)
 
-    return res
+def _char_table(chars: List[str]) -> np.ndarray:
+    """Lookup table from label-1 to char."""
+    return _char_table_cached(tuple(chars))
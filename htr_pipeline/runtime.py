@@ -0,0 +1,191 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pkg_resources import resource_filename
+
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    """Configure the ONNX Runtime sessions of the detector and reader models (shared by the whole process)."""
+    intra_op_num_threads: int = 0  # threads used to parallelize an operator, 0 lets ONNX Runtime decide
+    inter_op_num_threads: int = 0  # threads used to run independent operators (parallel execution mode only)
+    allow_spinning: bool = True  # idle threads busy-wait for work, disable when processes share the cores
+    execution_mode: str = 'sequential'  # 'sequential' or 'parallel'
+    graph_optimization_level: str = 'all'  # 'disable', 'basic', 'extended' or 'all'
+    enable_cpu_mem_arena: bool = True
+    enable_mem_pattern: bool = True
+    optimized_model_dir: Optional[str] = None  # if set, optimized models are saved there and reused
+    enable_profiling: bool = False  # write ONNX Runtime profiles (JSON) of all runs, see end_profiling()
+    profile_file_prefix: str = 'htr_pipeline'
+    providers: Tuple[str, ...] = ('CUDAExecutionProvider', 'CPUExecutionProvider')
+
+
+PRECISIONS = ('fp32', 'int8')
+
+_EXECUTION_MODES = {'sequential': 'ORT_SEQUENTIAL', 'parallel': 'ORT_PARALLEL'}
+_GRAPH_OPTIMIZATION_LEVELS = {'disable': 'ORT_DISABLE_ALL', 'basic': 'ORT_ENABLE_BASIC',
+                              'extended': 'ORT_ENABLE_EXTENDED', 'all': 'ORT_ENABLE_ALL'}
+
+# global vars holding the runtime config and the sessions created with it, sessions are created on first use
+_RUNTIME_CONFIG = RuntimeConfig()
+_SESSIONS: Dict[str, object] = {}
+_LOCK = threading.Lock()
+
+
+def configure_runtime(config: RuntimeConfig):
+    """Set the runtime config of the process. Already created sessions are dropped and get recreated on next use."""
+    global _RUNTIME_CONFIG
+    with _LOCK:
+        _RUNTIME_CONFIG = config
+        _SESSIONS.clear()
+
+
+def get_runtime_config() -> RuntimeConfig:
+    return _RUNTIME_CONFIG
+
+
+def model_file(model_name: str, precision: str = 'fp32') -> str:
+    """File name of the model with the given precision, int8 models are created by htr_pipeline.quantize."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision. Available: {list(PRECISIONS)}.')
+    return f'{model_name}.onnx' if precision == 'fp32' else f'{model_name}.{precision}.onnx'
+
+
+def _create_session(model_file: str, config: RuntimeConfig):
+    import onnxruntime as ort
+
+    if config.execution_mode not in _EXECUTION_MODES:
+        raise ValueError(f'Unknown execution mode. Available: {list(_EXECUTION_MODES)}.')
+    if config.graph_optimization_level not in _GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(f'Unknown graph optimization level. Available: {list(_GRAPH_OPTIMIZATION_LEVELS)}.')
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = config.intra_op_num_threads
+    options.inter_op_num_threads = config.inter_op_num_threads
+    options.add_session_config_entry('session.intra_op.allow_spinning', '1' if config.allow_spinning else '0')
+    options.add_session_config_entry('session.inter_op.allow_spinning', '1' if config.allow_spinning else '0')
+    options.execution_mode = getattr(ort.ExecutionMode, _EXECUTION_MODES[config.execution_mode])
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel,
+                                               _GRAPH_OPTIMIZATION_LEVELS[config.graph_optimization_level])
+    options.enable_cpu_mem_arena = config.enable_cpu_mem_arena
+    options.enable_mem_pattern = config.enable_mem_pattern
+    if config.enable_profiling:
+        options.enable_profiling = True
+        options.profile_file_prefix = f'{config.profile_file_prefix}_{os.path.splitext(model_file)[0]}'
+
+    model_path = resource_filename('htr_pipeline', f'models/{model_file}')
+    opt_path = tmp_opt_path = None
+    if config.optimized_model_dir:
+        # reuse the optimized model if it is newer than the original one, it needs no further optimization
+        # (optimized models may be specific to the hardware they were created on, so the dir should be host-local)
+        opt_path = os.path.join(config.optimized_model_dir,
+                                f'{os.path.splitext(model_file)[0]}.{config.graph_optimization_level}.opt.onnx')
+        if os.path.exists(opt_path) and os.path.getmtime(opt_path) >= os.path.getmtime(model_path):
+            model_path = opt_path
+            opt_path = None
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            os.makedirs(config.optimized_model_dir, exist_ok=True)
+            tmp_opt_path = f'{opt_path}.{os.getpid()}.tmp'
+            options.optimized_model_filepath = tmp_opt_path
+
+    available = ort.get_available_providers()
+    providers = [p for p in config.providers if p in available] or ['CPUExecutionProvider']
+    session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+    if opt_path:
+        os.replace(tmp_opt_path, opt_path)  # other processes may be optimizing the same model concurrently
+    return session
+
+
+def get_session(model_file: str):
+    """Returns the session for the given model file (located in htr_pipeline/models), creates it on first use."""
+    session = _SESSIONS.get(model_file)
+    if session is None:
+        with _LOCK:
+            session = _SESSIONS.get(model_file)
+            if session is None:
+                session = _SESSIONS[model_file] = _create_session(model_file, _RUNTIME_CONFIG)
+    return session
+
+
+def end_profiling() -> List[str]:
+    """Stop profiling of all sessions created so far, returns the paths of the written profile files."""
+    with _LOCK:
+        sessions = list(_SESSIONS.values())
+    if not _RUNTIME_CONFIG.enable_profiling:
+        return []
+    return [session.end_profiling() for session in sessions]
+
+
+class BoundIO:
+    """Preallocated float32 input and output buffers for one input shape, bound to a session via I/O binding.
+
+    Fill the input buffer in place and call run(). The returned output buffer is overwritten by the next run(). Batches
+    with fewer rows than the buffer fill only its first rows and call run(num_rows), the model runs on these rows only.
+    """
+
+    def __init__(self, session, shape: Tuple[int, ...]):
+        self.session = session
+        self.input = np.empty(shape, np.float32)
+        self.output = None
+        self._input_name = session.get_inputs()[0].name
+        self._output_name = session.get_outputs()[0].name
+        self._binding = session.io_binding()
+        self._binding.bind_cpu_input(self._input_name, self.input)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the buffers (the output buffer is allocated on the first full run)."""
+        return self.input.nbytes + (self.output.nbytes if self.output is not None else 0)
+
+    def run(self, num_rows: Optional[int] = None) -> np.ndarray:
+        if num_rows is not None and num_rows < len(self.input):
+            # partial batch: the leading rows are a contiguous view of the input buffer, the (smaller) output is
+            # allocated by ONNX Runtime
+            return self.session.run(None, {self._input_name: self.input[:num_rows]})[0]
+
+        if self.output is not None:
+            self.session.run_with_iobinding(self._binding)
+            return self.output
+
+        # output shape is only known after the first run, then the output is bound to a preallocated buffer as well
+        self._binding.bind_output(self._output_name)
+        self.session.run_with_iobinding(self._binding)
+        self.output = np.ascontiguousarray(self._binding.copy_outputs_to_cpu()[0])
+        self._binding.bind_output(self._output_name, 'cpu', 0, self.output.dtype, self.output.shape,
+                                  self.output.ctypes.data)
+        return self.output
+
+
+# buffers are kept per thread, so that concurrent inference calls never share them
+_BOUND_IO = threading.local()
+_MAX_BOUND_IO_PER_THREAD = 16
+_MAX_BOUND_IO_BYTES_PER_THREAD = 64 * 2 ** 20
+
+
+def get_bound_io(model_file: str, shape: Tuple[int, ...]) -> BoundIO:
+    """Returns the buffers of the current thread for the given model and input shape. The buffers may have more rows
+    (first dimension) than requested, see BoundIO.run(num_rows); buffers with fewer rows are replaced by larger ones.
+    Least recently used buffers are dropped when the thread holds more than 16 of them or more than 64 MB (the buffers
+    in use are always kept).
+
+    Callers should bucket shapes, so that only few different shapes occur and buffers are actually reused. Inputs of
+    many different shapes (e.g. pages) should be run without I/O binding instead."""
+    session = get_session(model_file)
+    cache = getattr(_BOUND_IO, 'cache', None)
+    if cache is None:
+        cache = _BOUND_IO.cache = OrderedDict()
+
+    key = (model_file, shape[1:])
+    bound_io = cache.get(key)
+    if bound_io is None or bound_io.session is not session or len(bound_io.input) < shape[0]:
+        bound_io = cache[key] = BoundIO(session, shape)
+    cache.move_to_end(key)
+    while len(cache) > 1 and (len(cache) > _MAX_BOUND_IO_PER_THREAD or
+                              sum(b.nbytes for b in cache.values()) > _MAX_BOUND_IO_BYTES_PER_THREAD):
+        cache.popitem(last=False)
+    return bound_io
@@ -1,29 +1,30 @@
+import contextvars
+import math
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional, Sequence, Union
 
 import cv2
 import numpy as np
-import onnxruntime as ort
-from pkg_resources import resource_filename
-from sklearn.cluster import DBSCAN
 
-from .aabb import AABB
-from .aabb_clustering import cluster_aabbs
-from .coding import decode, fg_by_cc, fg_by_threshold
-from .iou import compute_iou
+from .aabb import AABB, AABBArray
+from .aabb_clustering import cluster_aabbs, cluster_boxes, dbscan_labels
+from .coding import decode, decode_boxes, fg_by_cc, fg_by_threshold
+from .iou import compute_iou, overlapping_intervals
+from .scale import estimate_scale
+from ..profiling import stage
+from ..runtime import get_bound_io, get_session, model_file
 
 
-def _load_model():
-    """Loads model and model metadata."""
-    ort_session = ort.InferenceSession(resource_filename('htr_pipeline', 'models/detector.onnx'),
-                                       providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
+def _get_model(precision: str = 'fp32'):
+    """Returns model, it is loaded on first use."""
+    return get_session(model_file('detector', precision))
 
-    return ort_session
 
-
-# global vars holding the model and model metadata
-_ORT_SESSION = _load_model()
+def warmup(precision: str = 'fp32'):
+    """Load the model and run it once, so that the first call to detect() is not slowed down by initialization."""
+    _get_model(precision).run(None, {'input': np.zeros((1, 1, 64, 64), np.float32)})
 
 
 @dataclass
@@ -45,52 +46,201 @@ def pad_image(img):
     return res
 
 
-def detect(img: np.ndarray, scale: float, margin: int) -> List[DetectorRes]:
-    img_resized = cv2.resize(img, None, fx=scale, fy=scale)
-    img_padded = pad_image(img_resized)
-    img_batch = img_padded.astype(np.float32)[None, None] / 255 - 0.5
+def _fill_input(img: np.ndarray, out: np.ndarray):
+    """Pad (white) and normalize the image in place in the 2D model input out (at least as large as the image)."""
+    out.fill(0.5)
+    region = out[:img.shape[0], :img.shape[1]]
+    np.multiply(img, 1 / 255, out=region, casting='unsafe')
+    region -= 0.5
+
+
+def _decode_pred_map(pred_map: np.ndarray, input_height: int) -> np.ndarray:
+    """Decode the Nx4 boxes (pixel coordinates of the model input) of a single prediction map."""
+    with stage('detect.decode') as st:
+        boxes = decode_boxes(pred_map, comp_fg=fg_by_cc(0.5, 100), f=input_height / pred_map.shape[1])
+        st.set(items=len(boxes))
+    return boxes
+
+
+def _detect_boxes(img: np.ndarray, precision: str, reuse_buffers: bool = False) -> np.ndarray:
+    """Run the detector on a (resized) image, returns the decoded Nx4 boxes in pixel coordinates of the image.
+
+    Page sizes vary too much for reusing buffers, so by default the image is normalized into a new input array. Tiles
+    of the same size (reuse_buffers=True) are normalized into the bound buffers of the thread, see get_bound_io.
+    """
+    shape = (1, 1, ceil32(img.shape[0]), ceil32(img.shape[1]))
+    if reuse_buffers:
+        bound_io = get_bound_io(model_file('detector', precision), shape)
+        _fill_input(img, bound_io.input[0, 0])
+        with stage('detect.forward', shape=shape):
+            pred_map = bound_io.run()[0]
+    else:
+        inputs = np.empty(shape, np.float32)
+        _fill_input(img, inputs[0, 0])
+        with stage('detect.forward', shape=shape):
+            pred_map = _get_model(precision).run(None, {'input': inputs})[0][0]
+    return _decode_pred_map(pred_map, shape[2])
+
+
+def _tile_starts(size: int, tile_size: int, tile_overlap: int) -> List[int]:
+    """Start positions of the tiles covering an axis of the given size, neighboring tiles overlap by tile_overlap."""
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - tile_overlap
+    num_tiles = math.ceil((size - tile_overlap) / stride)
+    return [min(k * stride, size - tile_size) for k in range(num_tiles)]
+
+
+def _tile_bounds(starts: List[int], tile_size: int) -> np.ndarray:
+    """Each tile owns the part of the axis up to the middle of the overlap with its neighbors."""
+    mids = [(start + prev + tile_size) / 2 for prev, start in zip(starts, starts[1:])]
+    return np.array([-np.inf] + mids + [np.inf])
+
+
+def _detect_boxes_tiled(img: np.ndarray, precision: str, tile_size: int, tile_overlap: int,
+                        tile_workers: int) -> np.ndarray:
+    """Run the detector tile by tile, so that the model input never exceeds tile_size x tile_size pixels.
+
+    A box is kept by the tile that owns its center, words that are smaller than tile_overlap are therefore
+    completely seen by the tile that predicts them. Duplicates across tile seams are merged by the box clustering.
+    """
+    tile_size = ceil32(tile_size)
+    if not 0 <= tile_overlap < tile_size:
+        raise ValueError('tile_overlap must be non-negative and smaller than tile_size.')
+
+    ys = _tile_starts(img.shape[0], tile_size, tile_overlap)
+    xs = _tile_starts(img.shape[1], tile_size, tile_overlap)
+    y_bounds, x_bounds = _tile_bounds(ys, tile_size), _tile_bounds(xs, tile_size)
+
+    def detect_tile(tile_idx):
+        iy, ix = divmod(tile_idx, len(xs))
+        boxes = _detect_boxes(img[ys[iy]:ys[iy] + tile_size, xs[ix]:xs[ix] + tile_size], precision,
+                              reuse_buffers=True)
+        boxes += [xs[ix], xs[ix], ys[iy], ys[iy]]
+        cx = (boxes[:, 0] + boxes[:, 1]) / 2
+        cy = (boxes[:, 2] + boxes[:, 3]) / 2
+        owned = ((x_bounds[ix] <= cx) & (cx < x_bounds[ix + 1]) &
+                 (y_bounds[iy] <= cy) & (cy < y_bounds[iy + 1]))
+        return boxes[owned]
+
+    num_tiles = len(ys) * len(xs)
+    if tile_workers > 1 and num_tiles > 1:
+        with ThreadPoolExecutor(min(tile_workers, num_tiles)) as executor:
+            # each tile runs in a copy of the current context, so that profiling (see htr_pipeline.profiling) is kept
+            futures = [executor.submit(contextvars.copy_context().run, detect_tile, i) for i in range(num_tiles)]
+            tile_boxes = [future.result() for future in futures]
+    else:
+        tile_boxes = [detect_tile(i) for i in range(num_tiles)]
+    return np.concatenate(tile_boxes)
 
-    outputs = _ORT_SESSION.run(None, {'input': img_batch})
-    pred_map = outputs[0][0]
-    aabbs = decode(pred_map, comp_fg=fg_by_cc(0.5, 100), f=img_batch.shape[2] / pred_map.shape[1])
-    aabbs = [aabb.scale(1 / scale, 1 / scale) for aabb in aabbs if aabb.scale(1 / scale, 1 / scale)]
+
+def _to_detections(img: np.ndarray, boxes: np.ndarray, scale: float, margin: int) -> List[DetectorRes]:
+    """Cluster the decoded boxes (coordinates of the image resized by scale) into words and crop them from img."""
     h, w = img.shape
-    aabbs = [aabb.clip(AABB(0, w - 1, 0, h - 1)) for aabb in aabbs]  # bounding box must be inside img
-    clustered_aabbs = cluster_aabbs(aabbs)
+    aabbs = AABBArray.from_boxes(boxes).scale(1 / scale, 1 / scale)
+    aabbs = aabbs.clip(AABB(0, w - 1, 0, h - 1))  # bounding box must be inside img
+    with stage('detect.cluster_boxes', items=len(aabbs)):
+        clustered_aabbs = cluster_boxes(aabbs)
+
+    clustered_aabbs = clustered_aabbs.enlarge(margin)
+    clustered_aabbs = clustered_aabbs.clip(AABB(0, img.shape[1], 0, img.shape[0])).as_type(int)
+    clustered_aabbs = clustered_aabbs[clustered_aabbs.area() != 0]
 
     res = []
     for aabb in clustered_aabbs:
-        aabb = aabb.enlarge(margin)
-        aabb = aabb.as_type(int).clip(AABB(0, img.shape[1], 0, img.shape[0]))
-        if aabb.area() == 0:
-            continue
         crop = img[aabb.ymin:aabb.ymax, aabb.xmin:aabb.xmax]
         res.append(DetectorRes(crop, aabb))
 
     return res
 
 
+def detect(img: np.ndarray,
+           scale: Union[float, str],
+           margin: int,
+           precision: str = 'fp32',
+           tile_size: Optional[int] = None,
+           tile_overlap: int = 256,
+           tile_workers: int = 1) -> List[DetectorRes]:
+    """Detect words in the image.
+
+    The image is resized by scale before detection, scale='auto' estimates the scale from the text height of the page.
+    If tile_size is given, the detector runs on tiles of at most tile_size x tile_size pixels (of the resized image)
+    that overlap by tile_overlap pixels, which bounds the memory needed for large pages. Up to tile_workers tiles
+    are processed concurrently.
+    """
+    if scale == 'auto':
+        scale = estimate_scale(img)
+    img_resized = cv2.resize(img, None, fx=scale, fy=scale)
+    if tile_size is None:
+        boxes = _detect_boxes(img_resized, precision)
+    else:
+        boxes = _detect_boxes_tiled(img_resized, precision, tile_size, tile_overlap, tile_workers)
+    return _to_detections(img, boxes, scale, margin)
+
+
+def detect_batch(imgs: Sequence[np.ndarray],
+                 scale: Union[float, str],
+                 margin: int,
+                 precision: str = 'fp32',
+                 batch_size: int = 1,
+                 tile_size: Optional[int] = None,
+                 tile_overlap: int = 256,
+                 tile_workers: int = 1) -> List[List[DetectorRes]]:
+    """Detect words in several images, returns the same detections as calling detect() for each image.
+
+    Images whose model input has the same (padded) shape are detected together, up to batch_size images in one
+    inference call. In tiled mode (tile_size given), the images are detected one after the other.
+    """
+    if tile_size is not None:
+        return [detect(img, scale, margin, precision, tile_size, tile_overlap, tile_workers) for img in imgs]
+
+    scales = [estimate_scale(img) if scale == 'auto' else scale for img in imgs]
+    imgs_resized = [cv2.resize(img, None, fx=s, fy=s) for img, s in zip(imgs, scales)]
+
+    buckets = defaultdict(list)
+    for i, img in enumerate(imgs_resized):
+        buckets[ceil32(img.shape[0]), ceil32(img.shape[1])].append(i)
+
+    res = [None] * len(imgs)
+    for shape, idxs in buckets.items():
+        for start in range(0, len(idxs), batch_size):
+            batch_idxs = idxs[start:start + batch_size]
+            inputs = np.empty((len(batch_idxs), 1) + shape, np.float32)
+            for row, i in enumerate(batch_idxs):
+                _fill_input(imgs_resized[i], inputs[row, 0])
+
+            with stage('detect.forward', shape=inputs.shape):
+                pred_maps = _get_model(precision).run(None, {'input': inputs})[0]
+            for row, i in enumerate(batch_idxs):
+                boxes = _decode_pred_map(pred_maps[row], shape[0])
+                res[i] = _to_detections(imgs[i], boxes, scales[i], margin)
+
+    return res
+
+
 def _cluster_lines(detections: List[DetectorRes],
                    max_dist: float = 0.7,
                    min_words_per_line: int = 2) -> List[List[DetectorRes]]:
-    # compute matrix containing Jaccard distances (which is a proper metric)
+    # DBSCAN on the Jaccard distances (which is a proper metric) of the y-projected words, only pairs of overlapping
+    # intervals can be neighbors, which are found by a sweep over the intervals sorted by ymin
     num_bboxes = len(detections)
-    dist_mat = np.ones((num_bboxes, num_bboxes))
-    for i in range(num_bboxes):
-        for j in range(i, num_bboxes):
-            a = detections[i].aabb
-            b = detections[j].aabb
-            if a.ymin > b.ymax or b.ymin > a.ymax:
-                continue
-            intersection = min(a.ymax, b.ymax) - max(a.ymin, b.ymin)
-            union = a.height + b.height - intersection
-            iou = np.clip(intersection / union if union > 0 else 0, 0, 1)
-            dist_mat[i, j] = dist_mat[j, i] = 1 - iou  # Jaccard distance is defined as 1-iou
-
-    dbscan = DBSCAN(eps=max_dist, min_samples=min_words_per_line, metric='precomputed').fit(dist_mat)
+    ymin = np.array([det.aabb.ymin for det in detections])
+    ymax = np.array([det.aabb.ymax for det in detections])
+    height = ymax - ymin
+
+    if max_dist >= 1:
+        # all pairs are neighbors (the distance of non-overlapping words is 1)
+        labels = np.zeros(num_bboxes, int) if num_bboxes >= min_words_per_line else np.full(num_bboxes, -1)
+    else:
+        i, j = overlapping_intervals(ymin, ymax)
+        intersection = np.minimum(ymax[i], ymax[j]) - np.maximum(ymin[i], ymin[j])
+        union = height[i] + height[j] - intersection
+        iou = np.clip(np.divide(intersection, union, out=np.zeros(len(i)), where=union > 0), 0, 1)
+        close = 1 - iou <= max_dist  # Jaccard distance is defined as 1-iou
+        labels = dbscan_labels(num_bboxes, i[close], j[close], height > 0, min_words_per_line)
 
     clustered = defaultdict(list)
-    for i, cluster_id in enumerate(dbscan.labels_):
+    for i, cluster_id in enumerate(labels):
         if cluster_id == -1:
             continue
         clustered[cluster_id].append(detections[i])
@@ -112,7 +262,8 @@ def sort_multiline(detections: List[DetectorRes],
     Returns:
         List of lines, each line itself a list of detections.
     """
-    lines = _cluster_lines(detections, max_dist, min_words_per_line)
+    with stage('sort_multiline', items=len(detections)):
+        lines = _cluster_lines(detections, max_dist, min_words_per_line)
     res = []
     for line in lines:
         res += sort_line(line)
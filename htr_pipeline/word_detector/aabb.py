@@ -1,14 +1,48 @@
 import numpy as np
 
+from .iou import compute_iou_mat
 
-class AABB:
-    """axis aligned bounding box"""
 
-    def __init__(self, xmin, xmax, ymin, ymax):
-        self.xmin = xmin
-        self.xmax = xmax
-        self.ymin = ymin
-        self.ymax = ymax
+class AABBArray:
+    """axis aligned bounding boxes, stored as four contiguous numpy columns xmin, xmax, ymin, ymax
+
+    Supports the operations of AABB on all boxes at once, indexing with an int gives an AABB view of a single box.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data  # 4xN array, rows are xmin, xmax, ymin, ymax
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        """create from Nx4 array with the columns xmin, xmax, ymin, ymax"""
+        return cls(np.ascontiguousarray(np.asarray(boxes).reshape(-1, 4).T))
+
+    @classmethod
+    def from_aabbs(cls, aabbs):
+        return cls.from_boxes([[aabb.xmin, aabb.xmax, aabb.ymin, aabb.ymax] for aabb in aabbs])
+
+    @property
+    def boxes(self):
+        """Nx4 view with the columns xmin, xmax, ymin, ymax"""
+        return self.data.T
+
+    @property
+    def xmin(self):
+        return self.data[0]
+
+    @property
+    def xmax(self):
+        return self.data[1]
+
+    @property
+    def ymin(self):
+        return self.data[2]
+
+    @property
+    def ymax(self):
+        return self.data[3]
 
     @property
     def height(self):
@@ -18,60 +52,166 @@ class AABB:
     def width(self):
         return self.xmax - self.xmin
 
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = int(idx) + len(self) if idx < 0 else int(idx)
+            if not 0 <= idx < len(self):
+                raise IndexError('box index out of range')
+            return AABB._view(self.data, idx)
+        return AABBArray(np.ascontiguousarray(self.data[:, idx]))
+
+    def __iter__(self):
+        return (AABB._view(self.data, i) for i in range(len(self)))
+
     def scale(self, fx, fy):
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = fx * new.xmin
-        new.xmax = fx * new.xmax
-        new.ymin = fy * new.ymin
-        new.ymax = fy * new.ymax
-        return new
+        return AABBArray(self.data * np.array([[fx], [fx], [fy], [fy]]))
 
     def scale_around_center(self, fx, fy):
         cx = (self.xmin + self.xmax) / 2
         cy = (self.ymin + self.ymax) / 2
+        return AABBArray(np.stack([cx - fx * (cx - self.xmin),
+                                   cx + fx * (self.xmax - cx),
+                                   cy - fy * (cy - self.ymin),
+                                   cy + fy * (self.ymax - cy)]))
+
+    def translate(self, tx, ty):
+        return AABBArray(self.data + np.array([[tx], [tx], [ty], [ty]]))
+
+    def as_type(self, t):
+        return AABBArray(self.data.astype(t))
+
+    def enlarge_to_int_grid(self):
+        return AABBArray(np.stack([np.floor(self.xmin), np.ceil(self.xmax), np.floor(self.ymin), np.ceil(self.ymax)]))
+
+    def enlarge(self, v):
+        return AABBArray(self.data + np.array([[-v], [v], [-v], [v]]))
+
+    def clip(self, clip_aabb):
+        return AABBArray(np.stack([np.minimum(np.maximum(self.xmin, clip_aabb.xmin), clip_aabb.xmax),
+                                   np.maximum(np.minimum(self.xmax, clip_aabb.xmax), clip_aabb.xmin),
+                                   np.minimum(np.maximum(self.ymin, clip_aabb.ymin), clip_aabb.ymax),
+                                   np.maximum(np.minimum(self.ymax, clip_aabb.ymax), clip_aabb.ymin)]))
+
+    def area(self):
+        return (self.xmax - self.xmin) * (self.ymax - self.ymin)
+
+    def iou(self, other):
+        """intersection over union matrix of all pairs of boxes of self and other"""
+        return compute_iou_mat(self.boxes, other.boxes)
+
+    def median_per_cluster(self, labels):
+        """median box of each cluster (labels of -1 are ignored), clusters are ordered by their first box"""
+        labels = np.asarray(labels)
+        valid = labels >= 0
+        _, first_idx, inverse = np.unique(labels[valid], return_index=True, return_inverse=True)
+        cluster_rank = np.empty(len(first_idx), np.int64)
+        cluster_rank[np.argsort(first_idx, kind='stable')] = np.arange(len(first_idx))
+        clusters = cluster_rank[inverse.ravel()]
+
+        counts = np.bincount(clusters, minlength=len(first_idx))
+        starts = np.cumsum(counts) - counts
+        lo = starts + (counts - 1) // 2
+        hi = starts + counts // 2
 
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = cx - fx * (cx - self.xmin)
-        new.xmax = cx + fx * (self.xmax - cx)
-        new.ymin = cy - fy * (cy - self.ymin)
-        new.ymax = cy + fy * (self.ymax - cy)
-        return new
+        res = np.empty((4, len(counts)))
+        for i, values in enumerate(self.data[:, valid]):
+            values = values[np.lexsort((values, clusters))]
+            res[i] = (values[lo] + values[hi]) / 2
+        return AABBArray(res)
+
+
+class AABB:
+    """axis aligned bounding box, a view of a single box of an AABBArray
+
+    A box created from its coordinates stores them as float64 (like AABBArray.from_boxes), views keep the dtype of
+    their array, e.g. int for boxes converted by as_type(int).
+    """
+
+    __slots__ = ('_data', '_idx')
+
+    def __init__(self, xmin, xmax, ymin, ymax):
+        self._data = np.array([[xmin], [xmax], [ymin], [ymax]], np.float64)
+        self._idx = 0
+
+    @classmethod
+    def _view(cls, data, idx):
+        aabb = cls.__new__(cls)
+        aabb._data = data
+        aabb._idx = idx
+        return aabb
+
+    def __reduce__(self):
+        return AABB._view, (self._data[:, self._idx:self._idx + 1].copy(), 0)
+
+    def __repr__(self):
+        return f'AABB({self.xmin}, {self.xmax}, {self.ymin}, {self.ymax})'
+
+    def _as_array(self):
+        return AABBArray(self._data[:, self._idx:self._idx + 1])
+
+    @property
+    def xmin(self):
+        return self._data[0, self._idx]
+
+    @xmin.setter
+    def xmin(self, value):
+        self._data[0, self._idx] = value
+
+    @property
+    def xmax(self):
+        return self._data[1, self._idx]
+
+    @xmax.setter
+    def xmax(self, value):
+        self._data[1, self._idx] = value
+
+    @property
+    def ymin(self):
+        return self._data[2, self._idx]
+
+    @ymin.setter
+    def ymin(self, value):
+        self._data[2, self._idx] = value
+
+    @property
+    def ymax(self):
+        return self._data[3, self._idx]
+
+    @ymax.setter
+    def ymax(self, value):
+        self._data[3, self._idx] = value
+
+    @property
+    def height(self):
+        return self.ymax - self.ymin
+
+    @property
+    def width(self):
+        return self.xmax - self.xmin
+
+    def scale(self, fx, fy):
+        return self._as_array().scale(fx, fy)[0]
+
+    def scale_around_center(self, fx, fy):
+        return self._as_array().scale_around_center(fx, fy)[0]
 
     def translate(self, tx, ty):
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = new.xmin + tx
-        new.xmax = new.xmax + tx
-        new.ymin = new.ymin + ty
-        new.ymax = new.ymax + ty
-        return new
+        return self._as_array().translate(tx, ty)[0]
 
     def as_type(self, t):
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = t(new.xmin)
-        new.xmax = t(new.xmax)
-        new.ymin = t(new.ymin)
-        new.ymax = t(new.ymax)
-        return new
+        return self._as_array().as_type(t)[0]
 
     def enlarge_to_int_grid(self):
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = np.floor(new.xmin)
-        new.xmax = np.ceil(new.xmax)
-        new.ymin = np.floor(new.ymin)
-        new.ymax = np.ceil(new.ymax)
-        return new
+        return self._as_array().enlarge_to_int_grid()[0]
 
     def enlarge(self, v):
-        new = AABB(self.xmin - v, self.xmax + v, self.ymin - v, self.ymax + v)
-        return new
+        return self._as_array().enlarge(v)[0]
 
     def clip(self, clip_aabb):
-        new = AABB(self.xmin, self.xmax, self.ymin, self.ymax)
-        new.xmin = min(max(new.xmin, clip_aabb.xmin), clip_aabb.xmax)
-        new.xmax = max(min(new.xmax, clip_aabb.xmax), clip_aabb.xmin)
-        new.ymin = min(max(new.ymin, clip_aabb.ymin), clip_aabb.ymax)
-        new.ymax = max(min(new.ymax, clip_aabb.ymax), clip_aabb.ymin)
-        return new
+        return self._as_array().clip(clip_aabb)[0]
 
     def area(self):
         return (self.xmax - self.xmin) * (self.ymax - self.ymin)
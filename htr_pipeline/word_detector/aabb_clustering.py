@@ -1,32 +1,80 @@
-from collections import defaultdict
-
 import numpy as np
-from sklearn.cluster import DBSCAN
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
-from .aabb import AABB
-from .iou import compute_dist_mat
+from .aabb import AABBArray
+from .iou import compute_iou_pairs, overlapping_pairs
 
 
-def cluster_aabbs(aabbs):
-    """cluster aabbs using DBSCAN and the Jaccard distance between bounding boxes"""
+def dbscan_labels(num_points: int, i: np.ndarray, j: np.ndarray, self_neighbor: np.ndarray,
+                  min_samples: int) -> np.ndarray:
+    """DBSCAN cluster labels computed from the neighbor pairs of the points, identical to the labels of sklearn's
+    DBSCAN. The clusters are the connected components (scipy.sparse.csgraph.connected_components) of the sparse graph
+    of neighboring core points, no distance matrix is built.
+
+    Args:
+        num_points: Number of points.
+        i, j: Index arrays of all pairs i != j of neighboring points (distance <= eps), each pair listed once.
+        self_neighbor: Boolean array, True if a point is its own neighbor (distance to itself <= eps).
+        min_samples: Minimum number of neighbors (including the point itself) of a core point.
+
+    Returns:
+        Label of each point, -1 for noise. Clusters are numbered in the order of their first core point, a border
+        point belongs to the cluster with the lowest number among its core neighbors, just like in sklearn.
+    """
+    degree = self_neighbor.astype(np.int64)
+    degree += np.bincount(i, minlength=num_points) + np.bincount(j, minlength=num_points)
+    core = degree >= min_samples
+
+    # clusters are the connected components of the graph of neighboring core points
+    core_edge = core[i] & core[j]
+    graph = sparse.coo_matrix((np.ones(core_edge.sum(), np.int8), (i[core_edge], j[core_edge])),
+                              shape=(num_points, num_points))
+    _, component = connected_components(graph, directed=False)
+
+    # number the clusters by their first core point
+    core_idx = np.flatnonzero(core)
+    _, first_core = np.unique(component[core_idx], return_index=True)
+    cluster_of_component = np.full(num_points, -1)
+    cluster_of_component[component[core_idx[np.sort(first_core)]]] = np.arange(len(first_core))
+
+    labels = np.full(num_points, -1)
+    labels[core] = cluster_of_component[component[core]]
+
+    # border points join the lowest numbered cluster among their core neighbors
+    border = np.full(num_points, num_points)
+    for src, dst in ((i, j), (j, i)):
+        mask = core[src] & ~core[dst]
+        np.minimum.at(border, dst[mask], labels[src[mask]])
+    is_border = border < num_points
+    labels[is_border] = border[is_border]
+    return labels
+
+
+def cluster_boxes(aabbs: AABBArray, max_dist: float = 0.7, min_samples: int = 3) -> AABBArray:
+    """cluster boxes by the Jaccard distance between them (DBSCAN semantics), returns the median box of each cluster
+
+    Only pairs of overlapping boxes are ever compared (so max_dist must be < 1), memory grows with the number of
+    overlapping pairs instead of quadratically with the number of boxes.
+    """
     if len(aabbs) < 2:
         return aabbs
 
-    dists = compute_dist_mat(aabbs)
-    clustering = DBSCAN(eps=0.7, min_samples=3, metric='precomputed').fit(dists)
+    boxes = aabbs.boxes
+    pairs_i, pairs_j = [np.empty(0, np.int64)], [np.empty(0, np.int64)]
+    for i, j in overlapping_pairs(boxes):
+        close = 1 - compute_iou_pairs(boxes[i], boxes[j]) <= max_dist
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+    self_neighbor = 1 - compute_iou_pairs(boxes, boxes) <= max_dist
+
+    labels = dbscan_labels(len(aabbs), np.concatenate(pairs_i), np.concatenate(pairs_j), self_neighbor, min_samples)
+    return aabbs.median_per_cluster(labels)
 
-    clusters = defaultdict(list)
-    for i, c in enumerate(clustering.labels_):
-        if c == -1:
-            continue
-        clusters[c].append(aabbs[i])
 
-    res_aabbs = []
-    for curr_cluster in clusters.values():
-        xmin = np.median([aabb.xmin for aabb in curr_cluster])
-        xmax = np.median([aabb.xmax for aabb in curr_cluster])
-        ymin = np.median([aabb.ymin for aabb in curr_cluster])
-        ymax = np.median([aabb.ymax for aabb in curr_cluster])
-        res_aabbs.append(AABB(xmin, xmax, ymin, ymax))
+def cluster_aabbs(aabbs):
+    """cluster aabbs using DBSCAN and the Jaccard distance between bounding boxes"""
+    if len(aabbs) < 2:
+        return aabbs
 
-    return res_aabbs
+    return list(cluster_boxes(AABBArray.from_aabbs(aabbs).as_type(np.float64)))
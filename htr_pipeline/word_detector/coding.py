@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 
 from .aabb import AABB
+from ..profiling import stage
 
 
 class MapOrdering:
@@ -24,8 +25,8 @@ def encode(shape, gt, f=1.0):
         # segmentation map
         aabb_clip = AABB(0, shape[0] - 1, 0, shape[1] - 1)
 
-        aabb_word = aabb.scale_around_center(0.5, 0.5).as_type(int).clip(aabb_clip)
-        aabb_sur = aabb.as_type(int).clip(aabb_clip)
+        aabb_word = aabb.scale_around_center(0.5, 0.5).clip(aabb_clip).as_type(int)
+        aabb_sur = aabb.clip(aabb_clip).as_type(int)
         gt_map[MapOrdering.SEG_SURROUNDING, aabb_sur.ymin:aabb_sur.ymax + 1, aabb_sur.xmin:aabb_sur.xmax + 1] = 1
         gt_map[MapOrdering.SEG_SURROUNDING, aabb_word.ymin:aabb_word.ymax + 1, aabb_word.xmin:aabb_word.xmax + 1] = 0
         gt_map[MapOrdering.SEG_WORD, aabb_word.ymin:aabb_word.ymax + 1, aabb_word.xmin:aabb_word.xmax + 1] = 1
@@ -70,30 +71,45 @@ def fg_by_cc(thres, max_num):
     """take a maximum number of pixels per connected component, but at least 3 (->DBSCAN minPts)"""
 
     def func(seg_map):
-        seg_mask = (seg_map > thres).astype(np.uint8)
-        num_labels, label_img = cv2.connectedComponents(seg_mask, connectivity=4)
-        max_num_per_cc = max(max_num // (num_labels + 1), 3)  # at least 3 because of DBSCAN clustering
-
-        all_idx = [np.empty(0, np.int64), np.empty(0, np.int64)]
-        for curr_label in range(1, num_labels):
-            curr_idx = np.where(label_img == curr_label)
-            curr_idx = subsample(curr_idx, max_num_per_cc)
-            all_idx[0] = np.append(all_idx[0], curr_idx[0])
-            all_idx[1] = np.append(all_idx[1], curr_idx[1])
-        return tuple(all_idx)
+        with stage('detect.fg_by_cc') as st:
+            seg_mask = (seg_map > thres).astype(np.uint8)
+            num_labels, label_img, stats, _ = cv2.connectedComponentsWithStats(seg_mask, connectivity=4)
+            max_num_per_cc = max(max_num // (num_labels + 1), 3)  # at least 3 because of DBSCAN clustering
+
+            # all fg pixels in row-major order, grouped by component (stable sort keeps row-major order per component)
+            fg = np.flatnonzero(label_img)
+            labels = label_img.ravel()[fg]
+            fg = fg[np.argsort(labels, kind='stable')]
+
+            # subsample components with too many pixels in the same way as subsample() does
+            counts = stats[1:, cv2.CC_STAT_AREA].astype(np.int64)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            large = counts > max_num_per_cc
+            if large.any():
+                f = counts[large] / max_num_per_cc
+                keep = np.ones(len(fg), bool)
+                rel_idx = (np.arange(max_num_per_cc)[None, :] * f[:, None]).astype(np.int64)
+                in_large = np.repeat(large, counts)
+                keep[in_large] = False
+                keep[(starts[large, None] + rel_idx).ravel()] = True
+                fg = fg[keep]
+            st.set(items=len(fg))
+
+        return np.divmod(fg, label_img.shape[1])
 
     return func
 
 
+def decode_boxes(pred_map, comp_fg=fg_by_threshold(0.5), f=1):
+    """decode one box per fg pixel, returns Nx4 array with the columns xmin, xmax, ymin, ymax"""
+    yc, xc = comp_fg(pred_map[MapOrdering.SEG_WORD])
+    pred = pred_map[..., yc, xc]
+    boxes = np.stack([xc - pred[MapOrdering.GEO_LEFT],
+                      xc + pred[MapOrdering.GEO_RIGHT],
+                      yc - pred[MapOrdering.GEO_TOP],
+                      yc + pred[MapOrdering.GEO_BOTTOM]], axis=1).astype(np.float64, copy=False)
+    return boxes * f
+
+
 def decode(pred_map, comp_fg=fg_by_threshold(0.5), f=1):
-    idx = comp_fg(pred_map[MapOrdering.SEG_WORD])
-    pred_map_masked = pred_map[..., idx[0], idx[1]]
-    aabbs = []
-    for yc, xc, pred in zip(idx[0], idx[1], pred_map_masked.T):
-        t = pred[MapOrdering.GEO_TOP]
-        b = pred[MapOrdering.GEO_BOTTOM]
-        l = pred[MapOrdering.GEO_LEFT]
-        r = pred[MapOrdering.GEO_RIGHT]
-        aabb = AABB(xc - l, xc + r, yc - t, yc + b)
-        aabbs.append(aabb.scale(f, f))
-    return aabbs
+    return [AABB(*box) for box in decode_boxes(pred_map, comp_fg, f)]
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 
 
 def compute_iou(ra, rb):
@@ -18,29 +19,102 @@ def compute_iou(ra, rb):
     return iou
 
 
-def compute_dist_mat(aabbs):
-    """Jaccard distance matrix of all pairs of aabbs"""
-    num_aabbs = len(aabbs)
+def _as_boxes(aabbs):
+    """Nx4 array (xmin, xmax, ymin, ymax) of a list of aabbs"""
+    return np.array([[aabb.xmin, aabb.xmax, aabb.ymin, aabb.ymax] for aabb in aabbs], dtype=np.float64).reshape(-1, 4)
 
-    dists = np.zeros((num_aabbs, num_aabbs))
-    for i in range(num_aabbs):
-        for j in range(num_aabbs):
-            if j > i:
-                break
 
-            dists[i, j] = dists[j, i] = 1 - compute_iou(aabbs[i], aabbs[j])
+def compute_iou_pairs(boxes1, boxes2):
+    """element-wise intersection over union of boxes given as arrays (..., 4) with xmin, xmax, ymin, ymax, the
+    arrays are broadcast against each other"""
+    xmin1, xmax1, ymin1, ymax1 = np.moveaxis(boxes1, -1, 0)
+    xmin2, xmax2, ymin2, ymax2 = np.moveaxis(boxes2, -1, 0)
 
-    return dists
+    w = np.minimum(xmax1, xmax2) - np.maximum(xmin1, xmin2)
+    h = np.minimum(ymax1, ymax2) - np.maximum(ymin1, ymin2)
+    intersection = np.where((w >= 0) & (h >= 0), w * h, 0)
+    union = (xmax1 - xmin1) * (ymax1 - ymin1) + (xmax2 - xmin2) * (ymax2 - ymin2) - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection, dtype=np.float64), where=union > 0)
+
+
+def compute_iou_mat(boxes1, boxes2):
+    """intersection over union of all pairs of boxes given as Nx4 and Mx4 arrays (xmin, xmax, ymin, ymax)"""
+    return compute_iou_pairs(boxes1[:, None, :], boxes2[None, :, :])
+
+
+def compute_dist_mat(aabbs):
+    """Jaccard distance matrix of all pairs of aabbs"""
+    boxes = _as_boxes(aabbs)
+    return 1 - compute_iou_mat(boxes, boxes)
 
 
 def compute_dist_mat_2(aabbs1, aabbs2):
     """Jaccard distance matrix of all pairs of aabbs from lists aabbs1 and aabbs2"""
-    num_aabbs1 = len(aabbs1)
-    num_aabbs2 = len(aabbs2)
+    return 1 - compute_iou_mat(_as_boxes(aabbs1), _as_boxes(aabbs2))
+
+
+def overlapping_intervals(lo, hi):
+    """Index pairs (i, j) of all intersecting (or touching) 1D intervals [lo, hi], each pair listed once.
+
+    The intervals are sorted by their start, each interval is paired with the following intervals that start before
+    it ends. Runtime is O(N log N) plus the number of pairs.
+    """
+    num_intervals = len(lo)
+    order = np.argsort(lo, kind='stable')
+    ends = np.searchsorted(lo[order], hi[order], side='right')
+    counts = np.maximum(ends - np.arange(num_intervals) - 1, 0)
+    i = np.repeat(np.arange(num_intervals), counts)
+    j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return order[i], order[j]
+
+
+def overlapping_pairs(boxes, max_pairs_per_chunk=1 << 20):
+    """Yield chunks (i, j) of index pairs i < j of boxes (Nx4 array) that overlap, found by sort and sweep.
+
+    Boxes are sorted along the axis that gives fewer candidate pairs, each box is paired with the following boxes
+    whose interval starts before its own interval ends, the candidates are then filtered by the other axis.
+    """
+    num_boxes = len(boxes)
+    best = None
+    for axis in (0, 1):
+        order = np.argsort(boxes[:, 2 * axis], kind='stable')
+        starts = boxes[order, 2 * axis]
+        ends = np.searchsorted(starts, boxes[order, 2 * axis + 1], side='right')
+        counts = np.maximum(ends - np.arange(num_boxes) - 1, 0)
+        if best is None or counts.sum() < best[1].sum():
+            best = order, counts
+    order, counts = best
+
+    # process the sorted boxes in chunks, so that the candidate pairs of a chunk stay below the limit
+    cum_counts = np.cumsum(counts)
+    begin = 0
+    while begin < num_boxes:
+        offset = cum_counts[begin - 1] if begin else 0
+        end = max(int(np.searchsorted(cum_counts, offset + max_pairs_per_chunk, side='right')), begin + 1)
+        chunk_counts = counts[begin:end]
+        i = np.repeat(np.arange(begin, end), chunk_counts)
+        j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        i, j = order[i], order[j]
+        overlap = ((boxes[i, 0] <= boxes[j, 1]) & (boxes[j, 0] <= boxes[i, 1]) &
+                   (boxes[i, 2] <= boxes[j, 3]) & (boxes[j, 2] <= boxes[i, 3]))
+        yield i[overlap], j[overlap]
+        begin = end
+
 
-    dists = np.zeros((num_aabbs1, num_aabbs2))
-    for i in range(num_aabbs1):
-        for j in range(num_aabbs2):
-            dists[i, j] = 1 - compute_iou(aabbs1[i], aabbs2[j])
+def compute_sparse_dist_mat(boxes, max_dist=1.0):
+    """Jaccard distance matrix of all pairs of boxes (Nx4 array) as sparse CSR matrix, which only stores pairs with a
+    distance <= max_dist (including the diagonal). Missing entries are treated as non-neighbors by DBSCAN."""
+    num_boxes = len(boxes)
+    rows, cols, data = [np.arange(num_boxes)], [np.arange(num_boxes)], [1 - compute_iou_pairs(boxes, boxes)]
+    for i, j in overlapping_pairs(boxes):
+        dist = 1 - compute_iou_pairs(boxes[i], boxes[j])
+        close = dist <= max_dist
+        i, j, dist = i[close], j[close], dist[close]
+        rows += [i, j]
+        cols += [j, i]
+        data += [dist, dist]
 
+    dists = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(num_boxes, num_boxes))
+    dists.sort_indices()
     return dists
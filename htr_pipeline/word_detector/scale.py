@@ -0,0 +1,48 @@
+import math
+
+import cv2
+import numpy as np
+
+# word height (pixels) at which the detector works best, detection scale is chosen to bring the text to this height
+TARGET_WORD_HEIGHT = 40
+
+# size (longer side) of the thumbnail used to estimate the text height
+_THUMBNAIL_SIZE = 1024
+
+
+def estimate_text_height(img: np.ndarray) -> float:
+    """Estimate the height (pixels) of the handwritten words of a grayscale page, or 0 if no text is found.
+
+    The page is binarized (Otsu) on a thumbnail, the height of the ink components (letters, or whole words in cursive
+    writing) is measured. The upper quartile is used, so that dots, commas and broken strokes do not count.
+    """
+    f = min(1.0, _THUMBNAIL_SIZE / max(img.shape))
+    thumbnail = cv2.resize(img, None, fx=f, fy=f, interpolation=cv2.INTER_AREA) if f < 1 else img
+    _, ink = cv2.threshold(thumbnail, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+
+    stats = stats[1:]  # skip background
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    text = ((stats[:, cv2.CC_STAT_AREA] >= 4) &
+            (heights < thumbnail.shape[0] / 4) &  # ignore borders, rulings and large dark areas
+            (stats[:, cv2.CC_STAT_WIDTH] < thumbnail.shape[1] / 2))
+    if not text.any():
+        return 0.0
+    return float(np.percentile(heights[text], 75)) / f
+
+
+def estimate_scale(img: np.ndarray,
+                   target_height: float = TARGET_WORD_HEIGHT,
+                   min_scale: float = 0.1,
+                   max_scale: float = 1.0,
+                   step: float = 0.05) -> float:
+    """Smallest detection scale that brings the words of the page to the target height.
+
+    The scale is rounded up to a multiple of step (few distinct input shapes, so model buffers get reused) and
+    clipped to [min_scale, max_scale]. If no text is found, max_scale is returned.
+    """
+    text_height = estimate_text_height(img)
+    if text_height <= 0:
+        return max_scale
+    scale = math.ceil(target_height / text_height / step) * step
+    return float(np.clip(round(scale, 6), min_scale, max_scale))